@@ -1,12 +1,18 @@
 # View Defintion Runner on top of Pathling Extract API
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
 
 import requests
 import json
-from typing import List
+from typing import List, BinaryIO
+
+from job_profiling import profiled_worker
 
 VIEW_DEFINITION_RESOURCE_TYPE = "http://hl7.org/fhir/uv/sql-on-fhir/StructureDefinition/ViewDefinition"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 
 class Parameter:
@@ -128,18 +134,26 @@ def run_extraction_query(resource_type, parameters: Parameters, fhir_server_base
     return response.json()
 
 
-def poll_extraction_job(result_url, timeout=60):
-    response = requests.get(result_url, timeout=timeout)
+def poll_extraction_job(result_url, timeout=60, stream=False):
+    # The CSV is requested compressed and decompressed by requests while it is read
+    response = requests.get(result_url, timeout=timeout, stream=stream, headers={"Accept-Encoding": "gzip, deflate"})
     return response
 
 
-def run_view_definition(view_definition, fhir_server_base_url, timeout=60):
+def run_view_definition(view_definition, fhir_server_base_url, timeout=60, partition_filter: str = None,
+                        stream=False):
+    """
+    @param partition_filter: Additional FHIRPath filter restricting the extract to a partition of the cohort
+    @param stream: Whether to return the result before its content is downloaded
+    """
     parameters = Parameters()
     for select in view_definition.select:
         for column in select.column:
             parameters.parameter.append(ColumnParameter(column.path))
     for where in view_definition.where:
         parameters.parameter.append(FilterParameter(where.path))
+    if partition_filter:
+        parameters.parameter.append(FilterParameter(partition_filter))
 
     response = run_extraction_query(view_definition.resource, parameters, fhir_server_base_url, timeout)
     print(response)
@@ -152,7 +166,72 @@ def run_view_definition(view_definition, fhir_server_base_url, timeout=60):
             break  # Exit the loop once the URL is found
     if not result_url:
         print("URL not found in the response.")
-    return poll_extraction_job(result_url, timeout)
+    return poll_extraction_job(result_url, timeout, stream)
+
+
+def fhirpath_string(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def create_partition_filters(patient_id_path: str, patient_ids: List[str], num_partitions: int) -> List[str]:
+    """
+    Splits the sorted patient IDs into contiguous ranges of similar size and creates a FHIRPath filter for each of
+    them. The first and last range are open so that the partitions together cover every resource. Resources without
+    a patient ID (e.g. with a Group as subject) satisfy neither comparison, so the first partition includes them
+    explicitly.
+
+    @param patient_id_path: FHIRPath of the patient ID within the resource of the view definition, either the ID
+    itself or a reference to the patient
+    """
+    prefix = "Patient/" if patient_id_path.endswith(".reference") else ""
+    sorted_ids = sorted(set(str(patient_id) for patient_id in patient_ids))
+    num_partitions = max(1, min(num_partitions, len(sorted_ids)))
+    if num_partitions == 1:
+        return [None]
+
+    bounds = [prefix + sorted_ids[(index * len(sorted_ids)) // num_partitions] for index in range(1, num_partitions)]
+    partition_filters = []
+    for index in range(num_partitions):
+        conditions = []
+        if index > 0:
+            conditions.append(f"{patient_id_path} >= {fhirpath_string(bounds[index - 1])}")
+        if index < num_partitions - 1:
+            conditions.append(f"{patient_id_path} < {fhirpath_string(bounds[index])}")
+        partition_filter = " and ".join(conditions)
+        if index == 0:
+            partition_filter = f"({patient_id_path}).empty() or {partition_filter}"
+        partition_filters.append(partition_filter)
+    return partition_filters
+
+
+def run_partitioned_view_definition(view_definition, fhir_server_base_url, partition_filters: List[str],
+                                    output: BinaryIO, timeout=60, max_workers=4):
+    """
+    Runs one extract per partition concurrently and writes the CSV results to output in the order of the partitions.
+    Each result is streamed to a temporary file while downloading, so memory use does not grow with the cohort size.
+
+    @param partition_filters: FHIRPath filters of the partitions as created by create_partition_filters
+    """
+    def extract_partition(partition_filter):
+        response = run_view_definition(view_definition, fhir_server_base_url, timeout, partition_filter, stream=True)
+        response.raise_for_status()
+        partition_file = tempfile.TemporaryFile()
+        last_chunk = b""
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            partition_file.write(chunk)
+            last_chunk = chunk or last_chunk
+        # Keep the last row of a partition separate from the first row of the next one
+        if last_chunk and not last_chunk.endswith(b"\n"):
+            partition_file.write(b"\n")
+        partition_file.seek(0)
+        return partition_file
+
+    extract_partition = profiled_worker(extract_partition)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(extract_partition, partition_filter) for partition_filter in partition_filters]
+        for future in futures:
+            with future.result() as partition_file:
+                shutil.copyfileobj(partition_file, output, DOWNLOAD_CHUNK_SIZE)
 
 
 def get_column_names(view_definition: ViewDefinition):
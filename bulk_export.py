@@ -0,0 +1,223 @@
+# Staging of cohort data with the FHIR Bulk Data Group/[id]/$export operation
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from job_profiling import profiled_worker
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Issues reported in the error files of an export that make it incomplete, others (warning, information) are logged
+FAILED_EXPORT_SEVERITIES = {"fatal", "error"}
+MAX_LOGGED_ISSUES = 20
+
+
+class BulkExportError(RuntimeError):
+    pass
+
+
+def create_cohort_group(session: requests.Session, fhir_base_url: str, patient_ids: List[str]) -> str:
+    """
+    Registers the cohort as a Group on the FHIR server
+
+    @return: Id of the created Group
+    """
+    group = {
+        "resourceType": "Group",
+        "type": "person",
+        "actual": True,
+        "member": [{"entity": {"reference": f"Patient/{patient_id}"}} for patient_id in patient_ids]
+    }
+    response = session.post(f"{fhir_base_url}/Group", json=group,
+                            headers={"Content-Type": "application/fhir+json", "Prefer": "return=representation"})
+    response.raise_for_status()
+    if response.content:
+        return response.json()["id"]
+    # Servers not returning the representation point to the new resource in the Location header
+    return response.headers["Location"].split("/Group/")[-1].split("/")[0]
+
+
+def delete_group(session: requests.Session, fhir_base_url: str, group_id: str):
+    # Only logs failures, as it runs during cleanup, where raising would hide the original error
+    try:
+        response = session.delete(f"{fhir_base_url}/Group/{group_id}")
+    except requests.RequestException as exc:
+        print(f"Failed to delete Group {group_id}: {repr(exc)}")
+        return
+    if not response.ok:
+        print(f"Failed to delete Group {group_id}: {response.status_code}, {response.text}")
+
+
+def kick_off_group_export(session: requests.Session, fhir_base_url: str, group_id: str,
+                          resource_types: List[str], elements: str = "") -> str:
+    """
+    @param elements: Value of the _elements parameter, e.g. "Observation.code,Observation.subject". Support for it is
+    optional, with lenient handling servers not supporting it export the full resources instead of failing.
+    @return: URL of the status endpoint of the export job
+    """
+    params = {"_type": ",".join(resource_types), "_outputFormat": "application/fhir+ndjson"}
+    prefer = "respond-async"
+    if elements:
+        params["_elements"] = elements
+        prefer += ", handling=lenient"
+    response = session.get(f"{fhir_base_url}/Group/{group_id}/$export", params=params,
+                           headers={"Accept": "application/fhir+json", "Prefer": prefer})
+    if response.status_code != 202:
+        raise BulkExportError(f"Export kick-off failed: {response.status_code}, {response.text}")
+    return response.headers["Content-Location"]
+
+
+def poll_export_job(session: requests.Session, status_url: str, poll_interval: float = 5.0,
+                    timeout: float = 3600.0) -> dict:
+    """
+    Polls the status endpoint until the export is complete, honouring Retry-After if the server sends it
+
+    @return: Export manifest listing the output files
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = session.get(status_url, headers={"Accept": "application/json"})
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code != 202:
+            raise BulkExportError(f"Export failed: {response.status_code}, {response.text}")
+        print(f"Export in progress: {response.headers.get('X-Progress', 'unknown progress')}")
+        retry_after = response.headers.get("Retry-After", "")
+        time.sleep(float(retry_after) if retry_after.isdigit() else poll_interval)
+    raise BulkExportError(f"Export did not complete within {timeout} seconds")
+
+
+def delete_export_job(session: requests.Session, status_url: str):
+    """
+    Cancels the export job if it is still running, otherwise signals the server that its output files can be removed.
+    Like delete_group, failures are only logged.
+    """
+    try:
+        response = session.delete(status_url)
+    except requests.RequestException as exc:
+        print(f"Failed to delete export job {status_url}: {repr(exc)}")
+        return
+    if not response.ok:
+        print(f"Failed to delete export job {status_url}: {response.status_code}, {response.text}")
+
+
+def file_request_headers(session: requests.Session, manifest: dict) -> Dict[str, Optional[str]]:
+    """
+    @return: Headers of requests for the output and error files of the manifest. The Authorization header of the
+    session is only sent if the manifest requires an access token, as e.g. pre-signed URLs reject it.
+    """
+    headers = {"Accept": "application/fhir+ndjson"}
+    if not manifest.get("requiresAccessToken", False):
+        headers["Authorization"] = None
+    elif "Authorization" not in session.headers and session.auth is None:
+        raise BulkExportError("The export files require an access token, but no authorization is configured for the "
+                              "FHIR server")
+    return headers
+
+
+def raise_for_export_errors(session: requests.Session, manifest: dict):
+    """
+    Reads the OperationOutcomes in the error files of the manifest and raises if any of them reports an error, as the
+    output of the export is incomplete then. Warnings and information are logged.
+    """
+    headers = file_request_headers(session, manifest)
+    failed_issues = []
+    for error in manifest.get("error", []):
+        response = session.get(error["url"], headers=headers)
+        response.raise_for_status()
+        for line in response.text.splitlines():
+            if not line.strip():
+                continue
+            for issue in json.loads(line).get("issue", []):
+                severity = issue.get("severity", "error")
+                message = issue.get("diagnostics") or issue.get("details", {}).get("text") or issue.get("code")
+                if severity in FAILED_EXPORT_SEVERITIES:
+                    failed_issues.append(f"{severity}: {message}")
+                else:
+                    print(f"Export {severity}: {message}")
+    if failed_issues:
+        raise BulkExportError(f"Export reported {len(failed_issues)} error(s): "
+                              + "; ".join(failed_issues[:MAX_LOGGED_ISSUES]))
+
+
+def download_export_file(session: requests.Session, url: str, path: str, headers: Dict[str, Optional[str]],
+                         project: Optional[Callable[[dict], dict]] = None) -> Tuple[int, int]:
+    """
+    Streams an NDJSON output file to disk without parsing it, unless the resources have to be projected
+
+    @param headers: Request headers as created by file_request_headers
+    @param project: If provided, applied to every resource before it is written
+    @return: Number of resources and bytes written
+    """
+    if project:
+        return download_projected_export_file(session, url, path, headers, project)
+    count = 0
+    bytes_written = 0
+    last_chunk = b""
+    with session.get(url, stream=True, headers=headers) as response:
+        response.raise_for_status()
+        with open(path, "wb") as file:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                count += chunk.count(b"\n")
+                bytes_written += len(chunk)
+                last_chunk = chunk or last_chunk
+    # The last line may lack its line break
+    if last_chunk and not last_chunk.endswith(b"\n"):
+        count += 1
+    return count, bytes_written
+
+
+def download_projected_export_file(session: requests.Session, url: str, path: str, headers: Dict[str, Optional[str]],
+                                   project: Callable[[dict], dict]) -> Tuple[int, int]:
+    count = 0
+    bytes_written = 0
+    with session.get(url, stream=True, headers=headers) as response:
+        response.raise_for_status()
+        with open(path, "wb") as file:
+            for line in response.iter_lines(DOWNLOAD_CHUNK_SIZE):
+                if not line.strip():
+                    continue
+                data = json.dumps(project(json.loads(line))).encode("utf-8") + b"\n"
+                file.write(data)
+                count += 1
+                bytes_written += len(data)
+    return count, bytes_written
+
+
+def download_export_files(session: requests.Session, manifest: dict, ndjson_dir: str, filename: str,
+                          resource_types: List[str], max_workers: int = 4,
+                          project: Optional[Callable[[dict], dict]] = None):
+    """
+    Downloads the output files of the manifest in parallel into the staging directory, named like the files written by
+    write_ndjson_by_resource_type
+
+    @param project: If provided, applied to every resource before it is written
+    @return: NDJSON file names per resource type and the staging statistics per resource type
+    """
+    downloads = []
+    file_name_by_type = defaultdict(list)
+    for output in manifest.get("output", []):
+        resource_type = output["type"]
+        if resource_type not in resource_types:
+            continue
+        type_filename = f"{filename}-{resource_type}-{len(file_name_by_type[resource_type]) + 1}.ndjson"
+        file_name_by_type[resource_type].append(type_filename)
+        downloads.append((resource_type, output["url"], os.path.join(ndjson_dir, type_filename)))
+
+    headers = file_request_headers(session, manifest)
+    statistics: Dict[str, Dict[str, int]] = {}
+    download = profiled_worker(download_export_file)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(resource_type, executor.submit(download, session, url, path, headers, project))
+                   for resource_type, url, path in downloads]
+        for resource_type, future in futures:
+            count, bytes_written = future.result()
+            type_statistics = statistics.setdefault(resource_type, {"count": 0, "bytes": 0})
+            type_statistics["count"] += count
+            type_statistics["bytes"] += bytes_written
+    return file_name_by_type, statistics
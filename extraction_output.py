@@ -0,0 +1,97 @@
+# Streaming output formats of the extraction result
+import csv
+import io
+import zipfile
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+
+import pandas as pd
+
+CSV_CHUNK_ROWS = 50000
+COPY_CHUNK_SIZE = 1024 * 1024
+LONG_FORMAT_COLUMNS = ["view", "row", "attribute", "value"]
+
+
+def iter_csv(data: pd.DataFrame, chunk_rows: int = CSV_CHUNK_ROWS, header: bool = True,
+             index: bool = True) -> Iterator[str]:
+    # Serialises the data frame in chunks of rows, so the CSV is never built as a single string
+    if data.empty:
+        if header:
+            yield data.to_csv(index=index)
+        return
+    for start in range(0, len(data), chunk_rows):
+        yield data.iloc[start:start + chunk_rows].to_csv(header=header and start == 0, index=index)
+
+
+def csv_header(column_names: List[str]) -> str:
+    header = io.StringIO()
+    csv.writer(header, lineterminator="\n").writerow(column_names)
+    return header.getvalue()
+
+
+def iter_long_format(views: Iterable[Tuple[str, List[str], BinaryIO]], patient_id_column: str,
+                     chunk_rows: int = CSV_CHUNK_ROWS) -> Iterator[str]:
+    """
+    Converts the views into one long table with a row per patient, view, view row and attribute. Empty values are
+    left out, so the output grows linearly with the extracted values.
+
+    @param views: Name, column names and headerless CSV result of each view
+    """
+    yield csv_header([patient_id_column] + LONG_FORMAT_COLUMNS)
+    for view_name, column_names, result_file in views:
+        if patient_id_column not in column_names:
+            raise ValueError(f"View '{view_name}' has no '{patient_id_column}' column")
+        result_file.seek(0)
+        offset = 0
+        try:
+            chunks = pd.read_csv(result_file, names=column_names, dtype=str, chunksize=chunk_rows)
+        except pd.errors.EmptyDataError:
+            continue
+        for chunk in chunks:
+            chunk = chunk.assign(view=view_name, row=range(offset, offset + len(chunk)))
+            offset += len(chunk)
+            long_chunk = chunk.melt(id_vars=[patient_id_column, "view", "row"], var_name="attribute",
+                                    value_name="value").dropna(subset=["value"])
+            yield long_chunk.sort_values("row", kind="stable").to_csv(header=False, index=False)
+
+
+class _StreamBuffer(io.RawIOBase):
+    """
+    Unseekable sink collecting what zipfile writes, so the archive can be yielded piece by piece
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_zip_archive(views: Iterable[Tuple[str, List[str], BinaryIO]]) -> Iterator[bytes]:
+    """
+    Streams a ZIP archive with one CSV file per view. The CSV results are copied into the archive as they are, only
+    a header row with the column names is added.
+
+    @param views: Name, column names and headerless CSV result of each view
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for index, (view_name, column_names, result_file) in enumerate(views):
+            file_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in view_name)
+            with archive.open(f"{index + 1:02d}_{file_name}.csv", mode="w", force_zip64=True) as entry:
+                entry.write(csv_header(column_names).encode("utf-8"))
+                result_file.seek(0)
+                while chunk := result_file.read(COPY_CHUNK_SIZE):
+                    entry.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
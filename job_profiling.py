@@ -0,0 +1,199 @@
+# Opt-in CPU and allocation profiling of single /run_ccdl jobs
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/ccdl-profiles")
+SAMPLING_INTERVAL = float(os.environ.get("PROFILE_SAMPLING_INTERVAL", "0.005"))
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATORS = 30
+
+_active = threading.local()
+
+
+class JobProfiler:
+    """
+    Samples the call stack of the thread running a job at a fixed interval and tracks its allocations with
+    tracemalloc. Samples are grouped by the stage active at the time, so the collapsed stacks can be rendered as a
+    flamegraph with one tower per stage. Thread pool workers running functions wrapped with profiled_worker are
+    sampled as well, below a "worker" frame of the stage that submitted them. Each sampled thread counts, so the
+    samples of a stage with parallel workers add up to more than its wall-clock time. The profile is written to
+    PROFILE_DIR when the profiler is stopped, so it can be retrieved from any gunicorn worker.
+
+    @param interval: Sampling interval in seconds
+    """
+
+    def __init__(self, job_id: str = None, interval: float = SAMPLING_INTERVAL):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.interval = interval
+        self.samples = Counter()
+        self.stages = {}
+        self._stage_stack = []
+        self._stage_peaks = []
+        self._thread_id = None
+        self._worker_threads = {}
+        self._stop_event = threading.Event()
+        self._sampler = None
+        self._started_tracemalloc = False
+        self._start_time = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._start_time = time.perf_counter()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._started_tracemalloc = True
+        self._sampler = threading.Thread(target=self._sample, name=f"profiler-{self.job_id}", daemon=True)
+        self._sampler.start()
+        _active.profiler = self
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            threads = [(self._thread_id, self._stage_stack)]
+            threads += [(thread_id, stages + ["worker"]) for thread_id, stages in dict(self._worker_threads).items()]
+            for thread_id, stages in threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.extend(reversed(stages or ["job"]))
+                self.samples[";".join(reversed(stack))] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Records time and peak traced memory of the enclosed code. Top allocators are only collected for top-level
+        stages, as taking the tracemalloc snapshots is expensive. A stage entered several times, e.g. the extract of
+        each view, is recorded once with the summed up time, the highest peak and the number of calls.
+        """
+        top_level = not self._stage_stack
+        if self._stage_peaks:
+            # Resetting the peak for the nested stage must not lose the peak of the enclosing one
+            self._stage_peaks[-1] = max(self._stage_peaks[-1], tracemalloc.get_traced_memory()[1])
+        self._stage_stack.append(name)
+        self._stage_peaks.append(0)
+        stage_name = "/".join(self._stage_stack)
+        start_snapshot = self._take_snapshot() if top_level else None
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = max(self._stage_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if self._stage_peaks:
+                self._stage_peaks[-1] = max(self._stage_peaks[-1], peak)
+            stage = self.stages.setdefault(stage_name, {"calls": 0, "seconds": 0.0, "peak_traced_bytes": 0})
+            stage["calls"] += 1
+            stage["seconds"] += elapsed
+            stage["peak_traced_bytes"] = max(stage["peak_traced_bytes"], peak)
+            if top_level:
+                statistics = self._take_snapshot().compare_to(start_snapshot, "lineno")
+                self._add_top_allocators(stage, statistics)
+            self._stage_stack.pop()
+
+    @staticmethod
+    def _add_top_allocators(stage: dict, statistics):
+        allocators = {allocator["location"]: allocator for allocator in stage.get("top_allocators", [])}
+        for stat in statistics[:TOP_ALLOCATORS]:
+            location = f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}"
+            allocator = allocators.setdefault(location, {"location": location, "size_diff_bytes": 0,
+                                                         "count_diff": 0})
+            allocator["size_diff_bytes"] += stat.size_diff
+            allocator["count_diff"] += stat.count_diff
+        stage["top_allocators"] = sorted(allocators.values(), key=lambda allocator: abs(allocator["size_diff_bytes"]),
+                                         reverse=True)[:TOP_ALLOCATORS]
+
+    @staticmethod
+    def _take_snapshot():
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)
+        ])
+
+    def stop(self):
+        _active.profiler = None
+        self._stop_event.set()
+        self._sampler.join()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        self.save()
+
+    def collapsed_stacks(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def summary(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "seconds": time.perf_counter() - self._start_time,
+            "sampling_interval": self.interval,
+            "samples": sum(self.samples.values()),
+            "stages": self.stages
+        }
+
+    def save(self):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(os.path.join(PROFILE_DIR, f"{self.job_id}.collapsed"), "w") as file:
+            file.write(self.collapsed_stacks())
+        with open(os.path.join(PROFILE_DIR, f"{self.job_id}.json"), "w") as file:
+            json.dump(self.summary(), file, indent=2)
+        print(f"Profile of job {self.job_id} written to {PROFILE_DIR}")
+
+
+@contextmanager
+def profiled_stage(name: str):
+    """
+    Records the enclosed code as a stage of the job profiled on the current thread, does nothing if the job is not
+    profiled
+    """
+    profiler = getattr(_active, "profiler", None)
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name):
+        yield
+
+
+def profiled_worker(function):
+    """
+    Wraps a function submitted to a thread pool, so the worker threads running it are sampled as part of the job
+    profiled on the submitting thread. Returns the function as is if the job is not profiled.
+    """
+    profiler = getattr(_active, "profiler", None)
+    if profiler is None:
+        return function
+    stages = list(profiler._stage_stack)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        thread_id = threading.get_ident()
+        profiler._worker_threads[thread_id] = stages
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler._worker_threads.pop(thread_id, None)
+    return wrapper
+
+
+def get_profile_path(job_id: str, extension: str):
+    """
+    @return: Path of the stored profile, None if the job id is invalid or no such profile exists
+    """
+    try:
+        job_id = uuid.UUID(job_id).hex
+    except ValueError:
+        return None
+    path = os.path.join(PROFILE_DIR, f"{job_id}.{extension}")
+    return path if os.path.isfile(path) else None
@@ -1,18 +1,28 @@
+import math
+import random
 import time
+import tempfile
 import pandas as pd
 import json
 import os
 import subprocess
 import docker
 from collections import defaultdict
-from typing import List, Dict
-from io import StringIO
+from typing import List, Dict, Tuple, BinaryIO
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, after_this_request, send_file
 from flask_cors import CORS
 import requests
 
-from PathlingViewDefinitionRunner import run_view_definition, ViewDefinition, get_column_names
+from PathlingViewDefinitionRunner import ViewDefinition, get_column_names, create_partition_filters, \
+    run_partitioned_view_definition
+from spark_sizing import SparkSizingProfile, compute_sizing_profile
+from job_profiling import JobProfiler, profiled_stage, get_profile_path
+from response_compression import negotiate_content_encoding, compress_stream
+from extraction_output import iter_csv, iter_long_format, iter_zip_archive
+from bulk_export import create_cohort_group, delete_group, kick_off_group_export, poll_export_job, \
+    delete_export_job, raise_for_export_errors, download_export_files
+from projection_planner import ProjectionPlan, plan_projection
 
 app = Flask(__name__)
 
@@ -24,23 +34,59 @@ PATHLING_BEARER_TOKEN = "f4a41f0d-fb75-45b5-88a7-461d4ad95f11"
 PATHLING_BASE_URL = os.environ.get("PATHLING_BASE_URL", "http://localhost:8093/fhir")
 FLARE_BASE_URL = os.environ.get("FLARE_BASE_URL", "http://localhost:8084")
 STAGING_DIR = "/usr/share/staging"
+NDJSON_DIR = "pathling/data/ndjson"
+PATIENT_ID_COLUMN = "Patient id"
+# Cohorts larger than this are extracted in several patient ID partitions, of which up to EXTRACT_MAX_WORKERS run
+# concurrently
+EXTRACT_PARTITION_SIZE = int(os.environ.get("EXTRACT_PARTITION_SIZE", "10000"))
+EXTRACT_MAX_WORKERS = int(os.environ.get("EXTRACT_MAX_WORKERS", "4"))
+# wide: all views outer-joined on the patient id, long: one row per patient, view row and attribute,
+# per_view: ZIP archive with one CSV per view
+OUTPUT_FORMATS = ["wide", "long", "per_view"]
+# everything: one Patient/[id]/$everything search per patient, bulk_export: a single Group/[id]/$export of the cohort
+STAGING_BACKEND = os.environ.get("STAGING_BACKEND", "everything")
+EXPORT_POLL_INTERVAL = float(os.environ.get("EXPORT_POLL_INTERVAL", "5"))
+EXPORT_TIMEOUT = float(os.environ.get("EXPORT_TIMEOUT", "3600"))
+EXPORT_DOWNLOAD_WORKERS = int(os.environ.get("EXPORT_DOWNLOAD_WORKERS", "4"))
+# Only stage the resource types and top-level elements the view definitions use
+STAGING_PROJECTION = os.environ.get("STAGING_PROJECTION", "true").lower() == "true"
+# Defaults of the preview mode, which only stages and extracts a random sample of the cohort
+PREVIEW_SAMPLE_SIZE = int(os.environ.get("PREVIEW_SAMPLE_SIZE", "100"))
+PREVIEW_SEED = int(os.environ.get("PREVIEW_SEED", "0"))
 
 SUPPORTED_RESOURCE_TYPES = ["Patient", "Condition", "Consent", "Procedure", "MedicationAdministration",
                             "MedicationStatement", "Specimen", "AllergyIntolerance", "Immunization", "Observation"]
 
 
-client = docker.from_env()
+# requests negotiates gzip/deflate (and zstd if zstandard is installed) and decompresses transparently, the session
+# additionally keeps the connection to the FHIR server alive across the $everything pages
+fhir_session = requests.Session()
+fhir_session.headers.update({"Accept": "application/fhir+json"})
 
+docker_client = None
 
-def start_pathling_service(compose_file_path):
-    # Start services as defined in the docker-compose.yml file
-    subprocess.run(["docker-compose", "-f", compose_file_path, "up", "-d"], check=True)
+
+def get_docker_client():
+    # Connect lazily so the module can be imported on hosts without a Docker daemon, e.g. for benchmarks
+    global docker_client
+    if docker_client is None:
+        docker_client = docker.from_env()
+    return docker_client
+
+
+def start_pathling_service(compose_file_path, sizing_profile: SparkSizingProfile = None):
+    # Start services as defined in the docker-compose.yml file, sized for the staged data if a profile is given
+    env = None
+    if sizing_profile:
+        print(f"Starting Pathling service with {sizing_profile}")
+        env = {**os.environ, **sizing_profile.to_env()}
+    subprocess.run(["docker-compose", "-f", compose_file_path, "up", "-d"], check=True, env=env)
     print("Pathling service starting...")
 
 
     # Wait for the service to become healthy
     for _ in range(30):  
-        service = client.containers.get(PATHLING_CONTAINER_NAME)
+        service = get_docker_client().containers.get(PATHLING_CONTAINER_NAME)
         health_status = service.attrs['State']['Health']['Status']
         if health_status == 'healthy':
             print("Pathling service is healthy.")
@@ -68,44 +114,200 @@ def update_status(new_status):
 def get_status():
     return jsonify(status_store)
 
+def is_profiling_requested():
+    # Profiling is enabled per request by the X-Profile header or the profile query parameter
+    flag = request.headers.get("X-Profile", request.args.get("profile", ""))
+    return flag.lower() in ("1", "true", "yes")
+
+@app.route("/profiles/<job_id>")
+def get_profile(job_id):
+    path = get_profile_path(job_id, "json")
+    if not path:
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(path, mimetype='application/json')
+
+@app.route("/profiles/<job_id>/flamegraph")
+def get_profile_flamegraph(job_id):
+    # Collapsed stacks as consumed by flamegraph.pl or speedscope
+    path = get_profile_path(job_id, "collapsed")
+    if not path:
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(path, mimetype='text/plain')
+
+def parse_view_definitions(view_definitions, output_format: str, max_rows_per_patient) -> List[ViewDefinition]:
+    """
+    Validates the extraction part of the request before anything is staged, so that invalid requests fail right away
+    instead of after staging and import
+
+    @return: The parsed view definitions
+    """
+    if not isinstance(view_definitions, list) or not view_definitions:
+        raise ValueError("viewDefinitions must be a non-empty list")
+    if max_rows_per_patient is not None and (not isinstance(max_rows_per_patient, int)
+                                             or isinstance(max_rows_per_patient, bool) or max_rows_per_patient < 1):
+        raise ValueError("maxRowsPerPatient must be a positive integer")
+
+    parsed_view_definitions = []
+    for index, definition in enumerate(view_definitions):
+        try:
+            view_definition = ViewDefinition.from_json(json.dumps(definition))
+        except (KeyError, TypeError) as exc:
+            raise ValueError(f"View definition {index + 1} is invalid, missing or malformed element {exc}")
+        parsed_view_definitions.append(view_definition)
+
+    # The long format always and the wide format for joining views or limiting rows relate rows to patients by the
+    # patient id column
+    needs_patient_id = output_format == "long" or (output_format == "wide" and (len(parsed_view_definitions) > 1
+                                                                                or max_rows_per_patient))
+    if needs_patient_id:
+        for view_definition in parsed_view_definitions:
+            if PATIENT_ID_COLUMN not in get_column_names(view_definition):
+                raise ValueError(f"View '{view_definition.name or view_definition.resource}' has no "
+                                 f"'{PATIENT_ID_COLUMN}' column, which the {output_format} output format requires")
+    return parsed_view_definitions
+
+
+def parse_preview(preview) -> Tuple[int, int]:
+    """
+    @param preview: true for the default sample, or an object with the optional keys "sampleSize" and "seed"
+    @return: Sample size and seed of the preview
+    """
+    if preview is True:
+        return PREVIEW_SAMPLE_SIZE, PREVIEW_SEED
+    if not isinstance(preview, dict):
+        raise ValueError("preview must be true or an object with sampleSize and seed")
+    sample_size = preview.get("sampleSize", PREVIEW_SAMPLE_SIZE)
+    seed = preview.get("seed", PREVIEW_SEED)
+    if not isinstance(sample_size, int) or isinstance(sample_size, bool) or sample_size < 1:
+        raise ValueError("preview sampleSize must be a positive integer")
+    if not isinstance(seed, int) or isinstance(seed, bool):
+        raise ValueError("preview seed must be an integer")
+    return sample_size, seed
+
+
+def sample_cohort(patient_ids: List[str], sample_size: int, seed: int) -> List[str]:
+    """
+    Draws a random sample of the cohort that is the same for the same cohort and seed, regardless of the order Flare
+    returns the patient ids in
+    """
+    population = sorted(set(patient_ids))
+    if sample_size >= len(population):
+        return population
+    return sorted(random.Random(seed).sample(population, sample_size))
+
+
+def stop_pipeline(profiler: JobProfiler = None):
+    if profiler:
+        profiler.stop()
+    print("Stopping Pathling service...")
+    update_status('Stopping Pathling service...')
+    stop_and_remove_pathling_service("pathling/docker-compose.yml")
+    subprocess.run(["rm", "-f", "pathling/data/ndjson/*.ndjson"], check=True)
+    update_status('Idle')
+
+
 @app.route("/run_ccdl", methods=["POST"])
 def run_ccdl():
     ccdl = json.loads(request.get_data())
     structured_query = ccdl.get("sq")
     view_definitions = ccdl.get("viewDefinitions")
+    output_format = ccdl.get("outputFormat", "wide")
+    max_rows_per_patient = ccdl.get("maxRowsPerPatient")
+    preview = ccdl.get("preview")
+    content_encoding = negotiate_content_encoding(request.accept_encodings)
 
-    print("Starting Pathling service...")
-    update_status('Starting Pathling service...')
+    if output_format not in OUTPUT_FORMATS:
+        return jsonify({"error": f"Unknown output format '{output_format}', expected one of {OUTPUT_FORMATS}"}), 400
 
     try:
-        start_pathling_service("pathling/docker-compose.yml")
-
+        parsed_view_definitions = parse_view_definitions(view_definitions, output_format, max_rows_per_patient)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
+    # An empty object requests a preview with the default sample size and seed as well
+    is_preview = preview is not None and preview is not False
+    if is_preview:
+        try:
+            preview_sample_size, preview_seed = parse_preview(preview)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
+
+    profiler = None
+    if is_profiling_requested():
+        profiler = JobProfiler()
+        profiler.start()
+        print(f"Profiling job {profiler.job_id}")
+
+        @after_this_request
+        def add_profile_header(response):
+            response.headers['X-Profile-Id'] = profiler.job_id
+            return response
+
+    # In preview mode the views are extracted while the response is streamed, so the pipeline is stopped once the
+    # response is closed
+    stop_on_close = False
+    try:
         print("Getting patient ids...")
         update_status('Getting patient ids...')
 
-        patient_ids = run_cohort_query(structured_query)
+        with profiled_stage("cohort_query"):
+            patient_ids = run_cohort_query(structured_query)
+
+        if is_preview:
+            cohort_size = len(patient_ids)
+            patient_ids = sample_cohort(patient_ids, preview_sample_size, preview_seed)
+            print(f"Previewing {len(patient_ids)} of {cohort_size} patients (seed {preview_seed})")
 
         print("Staging cohort data...")
         update_status('Staging cohort data...')
 
-        response, status_code = stage_cohort_data(patient_ids)
+        projection = None
+        if STAGING_PROJECTION:
+            projection = plan_projection(parsed_view_definitions)
+            print(f"Staging projection: {projection}")
+
+        with profiled_stage("staging"):
+            file_name_by_type, staging_statistics = stage_cohort_data(patient_ids, projection)
+
+        if not file_name_by_type:
+            return jsonify({"error": "No resources found"}), 404
+
+        print("Starting Pathling service...")
+        update_status('Starting Pathling service...')
+
+        start_pathling_service("pathling/docker-compose.yml", compute_sizing_profile(staging_statistics))
+
+        print("Importing cohort data...")
+        update_status('Importing cohort data...')
+
+        with profiled_stage("import"):
+            response = import_staged_data(file_name_by_type)
+
+        if response.status_code != 200:
+            return response.json(), response.status_code
+
+        if is_preview:
+            print("Streaming preview...")
+            update_status('Streaming preview...')
+
+            result = run_extraction(view_definitions, patient_ids, content_encoding, output_format,
+                                    max_rows_per_patient, stream_views=True)
+            result.call_on_close(lambda: stop_pipeline(profiler))
+            stop_on_close = True
+            return result
 
-        if status_code != 200:
-            return response, status_code
-        
         print("Running extraction...")
         update_status('Running extraction...')
-        
-        result = run_extraction(view_definitions)
+
+        with profiled_stage("extraction"):
+            result = run_extraction(view_definitions, patient_ids, content_encoding, output_format,
+                                    max_rows_per_patient)
 
         print("Done!")
         update_status('Done!')
     finally:
-        print("Stopping Pathling service...")
-        update_status('Stopping Pathling service...')
-        stop_and_remove_pathling_service("pathling/docker-compose.yml")
-        subprocess.run(["rm", "-f", "pathling/data/ndjson/*.ndjson"], check=True)
-        update_status('Idle')
+        if not stop_on_close:
+            stop_pipeline(profiler)
 
     return result
 
@@ -115,81 +317,231 @@ def run_cohort_query(structured_query):
     patient_ids = result.json()
     return patient_ids
 
-def run_extraction(view_definitions):
+def get_partition_filters(view_definition: ViewDefinition, patient_ids: List[str] = None):
+    patient_id_paths = [column.path for select in view_definition.select for column in select.column
+                        if column.name == PATIENT_ID_COLUMN]
+    num_partitions = math.ceil(len(patient_ids) / EXTRACT_PARTITION_SIZE) if patient_ids else 1
+    if num_partitions <= 1 or not patient_id_paths:
+        return [None]
+    return create_partition_filters(patient_id_paths[0], patient_ids, num_partitions)
+
+
+def extract_view(definition: dict, patient_ids: List[str] = None) -> Tuple[str, List[str], BinaryIO]:
+    """
+    @return: Name and column names of the view and a temporary file with its headerless CSV result
+    """
+    view_definition = ViewDefinition.from_json(json.dumps(definition))
+    print(json.dumps(definition))
+    partition_filters = get_partition_filters(view_definition, patient_ids)
+    print(f"Extracting {view_definition.resource} in {len(partition_filters)} partition(s)")
+
+    result_file = tempfile.TemporaryFile()
+    with profiled_stage("extract"):
+        run_partitioned_view_definition(view_definition, PATHLING_BASE_URL, partition_filters, result_file, 60,
+                                        EXTRACT_MAX_WORKERS)
+    return view_definition.name or view_definition.resource, get_column_names(view_definition), result_file
+
+
+def merge_views(views: List[Tuple[str, List[str], BinaryIO]], max_rows_per_patient: int = None) -> pd.DataFrame:
+    """
+    Outer-joins the views on the patient id. As patients with several rows in several views produce the product of
+    these rows, max_rows_per_patient optionally limits the rows kept per patient and view.
+    """
     merged_data = pd.DataFrame()
-    for definition in view_definitions:
-        view_definition = ViewDefinition.from_json(json.dumps(definition))
-        print(json.dumps(definition))
-        result = run_view_definition(view_definition, PATHLING_BASE_URL, 60)
-
-        column_names = get_column_names(view_definition)
-
-        result_df = pd.read_csv(StringIO(result.text), names=column_names)
+    for view_name, column_names, result_file in views:
+        result_file.seek(0)
+        result_df = pd.read_csv(result_file, names=column_names)
+        if max_rows_per_patient:
+            result_df = result_df.groupby(PATIENT_ID_COLUMN, sort=False, dropna=False).head(max_rows_per_patient)
 
         if merged_data.empty:
             merged_data = result_df
         else:
-            merged_data['Patient id'] = merged_data['Patient id'].astype(str)
-            result_df['Patient id'] = result_df['Patient id'].astype(str)
-            merged_data = pd.merge(merged_data, result_df, "outer", on='Patient id')
+            merged_data[PATIENT_ID_COLUMN] = merged_data[PATIENT_ID_COLUMN].astype(str)
+            result_df[PATIENT_ID_COLUMN] = result_df[PATIENT_ID_COLUMN].astype(str)
+            merged_data = pd.merge(merged_data, result_df, "outer", on=PATIENT_ID_COLUMN)
+    return merged_data
 
-    csv_output = merged_data.to_csv()
 
-    response = Response(csv_output, mimetype='text/csv')
-    response.headers['Content-Disposition'] = 'attachment; filename=extracted_data.csv'
-
-    return response
+def close_after(chunks, files: List[BinaryIO]):
+    # The view results are read while the response is streamed, so they can only be closed afterwards
+    try:
+        yield from chunks
+    finally:
+        for file in files:
+            file.close()
 
 
-def stage_cohort_data(patient_ids):
-    response_bundle = {
-        "resourceType": "Bundle",
-        "type": "collection",
-        "entry": []
-    }
+def iter_extracted_views(view_definitions, patient_ids: List[str], result_files: List[BinaryIO]):
+    # Extracts the views one after another, collecting their result files so they can be closed afterwards
+    for definition in view_definitions:
+        view = extract_view(definition, patient_ids)
+        result_files.append(view[2])
+        yield view
+
+
+def run_extraction(view_definitions, patient_ids: List[str] = None, content_encoding: str = None,
+                   output_format: str = "wide", max_rows_per_patient: int = None, stream_views: bool = False):
+    """
+    @param content_encoding: Encoding (gzip or zstd) to compress CSV output with while it is streamed, None for no
+    compression
+    @param output_format: One of OUTPUT_FORMATS
+    @param max_rows_per_patient: Limit of rows per patient and view for the wide format
+    @param stream_views: Extract the views while the response is streamed, so the rows of the first view are sent
+    before the next one is extracted. Pathling has to be kept running until the response is closed. The wide format
+    still needs all views before its first row.
+    """
+    result_files = []
+    views = iter_extracted_views(view_definitions, patient_ids, result_files)
+    if not stream_views:
+        views = list(views)
+
+    if output_format == "per_view":
+        # The archive is compressed already
+        response = Response(close_after(iter_zip_archive(views), result_files), mimetype='application/zip')
+        response.headers['Content-Disposition'] = 'attachment; filename=extracted_data.zip'
+        return response
+
+    if output_format == "long":
+        body = iter_long_format(views, PATIENT_ID_COLUMN)
+        file_name = 'extracted_data_long.csv'
+    else:
+        with profiled_stage("merge"):
+            merged_data = merge_views(views, max_rows_per_patient)
+        body = iter_csv(merged_data)
+        file_name = 'extracted_data.csv'
+
+    response = Response(compress_stream(close_after(body, result_files), content_encoding, flush_chunks=stream_views),
+                        mimetype='text/csv')
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Content-Disposition'] = f'attachment; filename={file_name}'
 
-    for patient_id in patient_ids:
-        # Initialize the search URL for the current patient
-        next_url = f"{FHIR_SERVER_BASE_URL}/Patient/{patient_id}/$everything?_count=500"
+    return response
 
-        while next_url:
-            print(f"Fetching: {next_url}")
-            # Make the request to the FHIR server
-            search_response = requests.get(next_url)
-            search_response.raise_for_status()
-            search_results = search_response.json()
 
-            # Extend the response bundle with the current page of results
-            response_bundle["entry"].extend(search_results.get("entry", []))
+def stage_cohort_data(patient_ids, projection: ProjectionPlan = None):
+    """
+    Fetches the data of all cohort patients from the FHIR server and writes it to NDJSON files in the staging directory
+    using the configured STAGING_BACKEND
 
-            # Check for a 'next' link to continue paging
-            next_link = [link for link in search_results.get("link", []) if link.get("relation") == "next"]
-            next_url = next_link[0].get("url") if next_link else None
-            if next_url:
-                next_url = f"{FHIR_SERVER_BASE_URL}{next_url.split('/fhir')[-1]}"
+    @param projection: If provided, only the resource types and elements of the plan are staged
+    @return: NDJSON file names per resource type and the staging statistics per resource type
+    """
+    if STAGING_BACKEND == "bulk_export":
+        return stage_cohort_data_bulk_export(patient_ids, projection)
+    return stage_cohort_data_everything(patient_ids, projection)
 
 
-    response = process_and_import_fhir_bundle(response_bundle)
+def stage_cohort_data_bulk_export(patient_ids, projection: ProjectionPlan = None):
+    resource_types = projection.resource_types(SUPPORTED_RESOURCE_TYPES) if projection else SUPPORTED_RESOURCE_TYPES
+    elements = projection.elements_parameter() if projection else ""
+    print(f"Registering cohort of {len(patient_ids)} patients as Group")
+    group_id = create_cohort_group(fhir_session, FHIR_SERVER_BASE_URL, patient_ids)
+    status_url = None
+    try:
+        with profiled_stage("export"):
+            status_url = kick_off_group_export(fhir_session, FHIR_SERVER_BASE_URL, group_id, resource_types, elements)
+            print(f"Export of Group {group_id} started: {status_url}")
+            manifest = poll_export_job(fhir_session, status_url, EXPORT_POLL_INTERVAL, EXPORT_TIMEOUT)
+            # A partially failed export must not be staged as if it was complete
+            raise_for_export_errors(fhir_session, manifest)
+        with profiled_stage("download"):
+            print(f"Downloading {len(manifest.get('output', []))} export files")
+            # Servers ignoring _elements send the full resources, so they are projected while downloading
+            return download_export_files(fhir_session, manifest, NDJSON_DIR, "example", resource_types,
+                                         EXPORT_DOWNLOAD_WORKERS, projection.project if projection else None)
+    finally:
+        if status_url:
+            # Cancels the export after a timeout or failure, otherwise the server can remove the exported files
+            delete_export_job(fhir_session, status_url)
+        delete_group(fhir_session, FHIR_SERVER_BASE_URL, group_id)
 
-    return response.json(), response.status_code
 
+def stage_cohort_data_everything(patient_ids, projection: ProjectionPlan = None):
+    resource_types = projection.resource_types(SUPPORTED_RESOURCE_TYPES) if projection else SUPPORTED_RESOURCE_TYPES
+    type_parameter = f"&_type={','.join(resource_types)}" if projection else ""
+    response_bundle = {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": []
+    }
 
-def process_and_import_fhir_bundle(bundle: dict):
+    # A resource in the compartment of several patients (e.g. a Specimen or Consent) is part of each patient's
+    # $everything result, but is only staged once
+    staged_keys = set()
+    num_duplicates = 0
+
+    def is_new(resource: dict) -> bool:
+        nonlocal num_duplicates
+        if "id" not in resource:
+            return True
+        key = f"{resource['resourceType']}/{resource['id']}"
+        if key in staged_keys:
+            num_duplicates += 1
+            return False
+        staged_keys.add(key)
+        return True
+
+    with profiled_stage("fetch"):
+        for patient_id in patient_ids:
+            # Initialize the search URL for the current patient
+            next_url = f"{FHIR_SERVER_BASE_URL}/Patient/{patient_id}/$everything?_count=500{type_parameter}"
+
+            while next_url:
+                print(f"Fetching: {next_url}")
+                # Make the request to the FHIR server
+                search_response = fhir_session.get(next_url)
+                search_response.raise_for_status()
+                search_results = search_response.json()
+
+                # Extend the response bundle with the resources of the current page, reduced to the elements of the
+                # projection right away so the bundle does not hold the unused ones
+                response_bundle["entry"].extend(
+                    {"resource": projection.project(entry["resource"]) if projection else entry["resource"]}
+                    for entry in search_results.get("entry", [])
+                    if entry.get("resource") and entry["resource"].get("resourceType") in resource_types
+                    and is_new(entry["resource"]))
+
+                # Check for a 'next' link to continue paging
+                next_link = [link for link in search_results.get("link", []) if link.get("relation") == "next"]
+                next_url = next_link[0].get("url") if next_link else None
+                if next_url:
+                    next_url = f"{FHIR_SERVER_BASE_URL}{next_url.split('/fhir')[-1]}"
+
+        print(f"Staging {len(response_bundle['entry'])} resources, skipped {num_duplicates} duplicates")
+
+    with profiled_stage("conversion"):
+        return write_fhir_bundle_to_ndjson(response_bundle)
+
+
+def write_fhir_bundle_to_ndjson(bundle: dict, projection: ProjectionPlan = None):
+    resource_types = projection.resource_types(SUPPORTED_RESOURCE_TYPES) if projection else SUPPORTED_RESOURCE_TYPES
     resources = [entry.get("resource") for entry in bundle["entry"] if entry.get("resource")]
-    resources = [resource for resource in resources if resource.get("resourceType") in SUPPORTED_RESOURCE_TYPES]
-    if not resources:
-        return jsonify({"error": "No resources found"}), 404
+    resources = [resource for resource in resources if resource.get("resourceType") in resource_types]
+    if projection:
+        resources = [projection.project(resource) for resource in resources]
     # Generate NDJSON files from the FHIR Bundle
-    file_name_by_type = write_ndjson_by_resource_type(resources, "example")
+    staging_statistics = {}
+    file_name_by_type = write_ndjson_by_resource_type(resources, "example", statistics=staging_statistics)
+    return file_name_by_type, staging_statistics
 
+
+def import_staged_data(file_name_by_type: Dict[str, List[str]]):
     # Generate the parameters for the $import request
     parameters = create_parameters(file_name_by_type, STAGING_DIR)
 
     # Send the import request to the Pathling server
     return import_files_to_pathling(parameters, PATHLING_BASE_URL, PATHLING_BEARER_TOKEN)
-    
 
-def write_ndjson_by_resource_type(resources: List[dict], filename: str, max_chunk_size=3000) -> Dict[str, List[str]]:
+
+def write_ndjson_by_resource_type(resources: List[dict], filename: str, max_chunk_size=3000,
+                                  statistics: Dict[str, Dict[str, int]] = None) -> Dict[str, List[str]]:
+    """
+    @param statistics: If provided, the number of resources ("count") and bytes written ("bytes") per resource type
+    are recorded in it
+    """
     def chunked(data, size):
         return (data[i:i + size] for i in range(0, len(data), size))
 
@@ -199,17 +551,24 @@ def write_ndjson_by_resource_type(resources: List[dict], filename: str, max_chun
 
     file_name_by_type = defaultdict(list)
     for resource_type, type_resources in resources_by_type.items():
+        type_bytes = 0
         for index, chunk in enumerate(chunked(type_resources, max_chunk_size)):
             type_filename = f"{filename}-{resource_type}-{index+1}.ndjson"
             file_name_by_type[resource_type].append(type_filename)
-            write_ndjson(chunk, "pathling/data/ndjson/" + type_filename)
+            type_bytes += write_ndjson(chunk, os.path.join(NDJSON_DIR, type_filename))
+        if statistics is not None:
+            statistics[resource_type] = {"count": len(type_resources), "bytes": type_bytes}
 
     return file_name_by_type
 
-def write_ndjson(resources: List[dict], filename: str):
+def write_ndjson(resources: List[dict], filename: str) -> int:
+    bytes_written = 0
     with open(filename, 'w') as file:
         for resource in resources:
-            file.write(json.dumps(resource) + '\n')
+            line = json.dumps(resource) + '\n'
+            file.write(line)
+            bytes_written += len(line.encode('utf-8'))
+    return bytes_written
 
 
 def create_parameters(file_name_by_type: Dict[str, List[str]], staging_dir, mode: str = None) -> Dict[str, List[Dict[str, str]]]:
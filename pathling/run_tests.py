@@ -2,6 +2,7 @@ import os
 import glob
 import json
 import copy
+import time
 import random
 import argparse
 import requests
@@ -16,6 +17,19 @@ aggregate_query_template = json.load(open(os.path.join('data', 'template', 'aggr
 headers = {
     'Content-Type': "application/fhir+json"
 }
+benchmark_modes = ['cold', 'warm', 'steady']
+# Warm rounds run against a Pathling server with the Spark caches of datasets and search results disabled, so every
+# query reads the Delta tables again while the JVM and the Spark session stay up
+warm_mode_environment = {
+    'PATHLING_CACHE_DATASETS': 'false',
+    'PATHLING_CACHE_RESULTS': 'false'
+}
+default_environment = {
+    'PATHLING_CACHE_DATASETS': 'true',
+    'PATHLING_CACHE_RESULTS': 'true'
+}
+spark_stage_metrics = ['executorRunTime', 'executorCpuTime', 'jvmGcTime', 'inputBytes', 'shuffleReadBytes',
+                       'shuffleWriteBytes', 'memoryBytesSpilled', 'diskBytesSpilled', 'peakExecutionMemory']
 
 
 def load_queries(path, file_pattern):
@@ -46,20 +60,23 @@ def generate_result_sets(query_sets):
     return result_sets
 
 
-def generate_test_run_order(query_sets, num_pre_run_queries=None):
-    # Flatten dictionary
+def generate_test_run_order(query_sets, num_pre_run_queries, rng):
+    """
+    @param num_pre_run_queries: Number of queries to run prior to recording elapsed time, capped at the number of
+    queries
+    @param rng: Seeded random.Random instance, so that the same seed always yields the same order
+    """
+    # Flatten dictionary in a fixed order, directory listings are not ordered
     total_query_set = []
-    for test_name, queries in query_sets.items():
-        for query_name, query in queries.items():
+    for test_name, queries in sorted(query_sets.items()):
+        for query_name, query in sorted(queries.items()):
             total_query_set.append((test_name, query_name, query))
 
-    # Determine number of queries to run prior to recording elapsed time if not provided
-    if num_pre_run_queries is None:
-        num_pre_run_queries = max(0, len(total_query_set))
-    pre_run_queries = random.sample(total_query_set, num_pre_run_queries)
+    num_pre_run_queries = min(max(0, num_pre_run_queries), len(total_query_set))
+    pre_run_queries = rng.sample(total_query_set, num_pre_run_queries)
 
     # Randomize order
-    random.shuffle(total_query_set)
+    rng.shuffle(total_query_set)
 
     return pre_run_queries, total_query_set
 
@@ -85,75 +102,181 @@ def generate_aggregate_request_body(query):
     return body
 
 
-def restart_containers(project):
+def restart_containers(project, environment=None):
+    """
+    @param environment: Variables overriding the defaults of docker-compose.yml, e.g. warm_mode_environment
+    """
     print(f"Restarting containers for project '{project}'")
-    subprocess.run(['docker', 'compose', '--project-name', project, 'down'])
-    subprocess.run(['docker', 'compose', '--project-name', project, 'up', '--wait'])
-
-
-def run_test(query_sets, url, project_name, rounds=None, num_pre_run_queries=None, timeout=1800):
-    if rounds is None:
-        rounds = 1
-    if num_pre_run_queries is None:
-        num_pre_run_queries = 0
-
-    print(f"Running tests: rounds: {rounds}, number of pre-run queries: {num_pre_run_queries}")
-    result_sets = generate_result_sets(query_sets)
-
-    for i in range(1, rounds + 1):
-        print(f"Round {i}")
-        pre_run_query_set, query_set = generate_test_run_order(query_sets, num_pre_run_queries)
-
-        restart_containers(project_name)
-
-        # Run pre-run queries
-        print("Running pre-run queries")
-        for test_name, query_name, query in pre_run_query_set:
-            print(f"Query [{test_name}]{query_name}")
-            # response = requests.post(url=f"{url}/Patient/_search", data=query, headers=headers)
-            try:
-                response = requests.post(url=f"{url}/Patient/$aggregate",
-                                         json=generate_aggregate_request_body(query),
-                                         headers=headers,
-                                         timeout=timeout)
-                if response.status_code != 200:
-                    print(f"Error while running pre-run query '{test_name}#{query_name}'")
-                    print(f"Status code: {response.status_code}. Reason:\n{response.text}")
-            except Exception as exc:
+    env = {**os.environ, **default_environment, **(environment or {})}
+    subprocess.run(['docker', 'compose', '--project-name', project, 'down'], env=env, check=True)
+    subprocess.run(['docker', 'compose', '--project-name', project, 'up', '--wait'], env=env, check=True)
+
+
+def reset_caches(project, reset_command):
+    # Runs the reset command privileged in the Pathling container, failing the benchmark if it fails, so that warm
+    # rounds never silently run without the reset
+    print(f"Resetting caches for project '{project}': {reset_command}")
+    subprocess.run(['docker', 'compose', '--project-name', project, 'exec', '-T', '--privileged', 'server',
+                    'sh', '-c', reset_command], check=True)
+
+
+def get_spark_application_id(spark_ui_url):
+    try:
+        response = requests.get(f"{spark_ui_url}/api/v1/applications", timeout=10)
+        response.raise_for_status()
+        return response.json()[0]['id']
+    except Exception as exc:
+        print(f"Spark monitoring API not available, not collecting Spark metrics. Reason: {repr(exc)}")
+        return None
+
+
+def get_spark_job_ids(spark_ui_url, app_id):
+    if app_id is None:
+        return None
+    try:
+        jobs = requests.get(f"{spark_ui_url}/api/v1/applications/{app_id}/jobs", timeout=10).json()
+        return {job['jobId'] for job in jobs}
+    except Exception as exc:
+        print(f"Failed to get Spark jobs. Reason: {repr(exc)}")
+        return None
+
+
+def collect_spark_metrics(spark_ui_url, app_id, known_job_ids, retries=5):
+    """
+    Collects the metrics of all Spark jobs started since known_job_ids was recorded, i.e. the jobs of the last query,
+    summed up over their stages, together with the physical plans of the SQL executions these jobs belong to
+    """
+    if app_id is None or known_job_ids is None:
+        return None
+    api_url = f"{spark_ui_url}/api/v1/applications/{app_id}"
+    try:
+        # Spark updates its status store asynchronously, so the last jobs may still be reported as running
+        for _ in range(retries):
+            jobs = [job for job in requests.get(f"{api_url}/jobs", timeout=10).json()
+                    if job['jobId'] not in known_job_ids]
+            if all(job['status'] != 'RUNNING' for job in jobs):
+                break
+            time.sleep(1)
+
+        job_ids = {job['jobId'] for job in jobs}
+        stage_ids = {stage_id for job in jobs for stage_id in job['stageIds']}
+        stages = [stage for stage in requests.get(f"{api_url}/stages", timeout=10).json()
+                  if stage['stageId'] in stage_ids]
+        executions = requests.get(f"{api_url}/sql", params={'details': 'true', 'planDescription': 'true'},
+                                  timeout=10).json()
+    except Exception as exc:
+        print(f"Failed to collect Spark metrics. Reason: {repr(exc)}")
+        return None
+
+    metrics = {
+        'jobs': len(jobs),
+        'stages': len([stage for stage in stages if stage['status'] != 'SKIPPED']),
+        'skipped_stages': len([stage for stage in stages if stage['status'] == 'SKIPPED']),
+        'tasks': sum(stage.get('numCompleteTasks', 0) for stage in stages)
+    }
+    for metric in spark_stage_metrics:
+        metrics[metric] = sum(stage.get(metric, 0) for stage in stages)
+    metrics['plans'] = [execution.get('planDescription') for execution in executions
+                        if job_ids & set(execution.get('successJobIds', []) + execution.get('failedJobIds', []) +
+                                         execution.get('runningJobIds', []))]
+    return metrics
+
+
+def run_query(url, query, timeout):
+    return requests.post(url=f"{url}/Patient/$aggregate",
+                         json=generate_aggregate_request_body(query),
+                         headers=headers,
+                         timeout=timeout)
+
+
+def run_pre_run_queries(pre_run_query_set, url, timeout):
+    print("Running pre-run queries")
+    for test_name, query_name, query in pre_run_query_set:
+        print(f"Query [{test_name}]{query_name}")
+        try:
+            response = run_query(url, query, timeout)
+            if response.status_code != 200:
                 print(f"Error while running pre-run query '{test_name}#{query_name}'")
-                print(f"Reason: {repr(exc)}")
-
-        # Run queries
-        print("Running queries")
-        for test_name, query_name, query in query_set:
-            print(f"Query [{test_name}]{query_name}")
-            # response = requests.post(url=f"{url}/Patient/_search", data=query, headers=headers)
-            try:
-                response = requests.post(url=f"{url}/Patient/$aggregate",
-                                         json=generate_aggregate_request_body(query),
-                                         headers=headers,
-                                         timeout=timeout)
-                if response.status_code == 200:
-                    time_elapsed = response.elapsed
-                    result_sets[test_name][query_name].append({
-                        'time': time_elapsed,
-                        'result': response.text
-                    })
-                    print(f"Success: Time elapsed: {time_elapsed}")
-                    print(response.text)
-                else:
-                    result_sets[test_name][query_name].append({
-                        'time': None,
-                        'result': response.text
-                    })
-                    print(f"Failure: {response.status_code}. Reason:\n{response.text}")
-            except Exception as exc:
+                print(f"Status code: {response.status_code}. Reason:\n{response.text}")
+        except Exception as exc:
+            print(f"Error while running pre-run query '{test_name}#{query_name}'")
+            print(f"Reason: {repr(exc)}")
+
+
+def run_measured_queries(query_set, result_sets, url, timeout, spark_ui_url, spark_app_id):
+    print("Running queries")
+    for test_name, query_name, query in query_set:
+        print(f"Query [{test_name}]{query_name}")
+        try:
+            known_job_ids = get_spark_job_ids(spark_ui_url, spark_app_id)
+            response = run_query(url, query, timeout)
+            spark_metrics = collect_spark_metrics(spark_ui_url, spark_app_id, known_job_ids)
+            if response.status_code == 200:
+                time_elapsed = response.elapsed
+                result_sets[test_name][query_name].append({
+                    'time': time_elapsed,
+                    'result': response.text,
+                    'spark': spark_metrics
+                })
+                print(f"Success: Time elapsed: {time_elapsed}")
+                print(response.text)
+            else:
                 result_sets[test_name][query_name].append({
                     'time': None,
-                    'result': repr(exc)
+                    'result': response.text,
+                    'spark': spark_metrics
                 })
-                print(f"Failure: {str(exc)}")
+                print(f"Failure: {response.status_code}. Reason:\n{response.text}")
+        except Exception as exc:
+            result_sets[test_name][query_name].append({
+                'time': None,
+                'result': repr(exc),
+                'spark': None
+            })
+            print(f"Failure: {str(exc)}")
+
+
+def run_test(query_sets, url, project_name, mode='cold', rounds=1, num_pre_run_queries=0, timeout=1800,
+             spark_ui_url=None, seed=0, reset_command=None):
+    """
+    Runs the queries in one of the benchmark modes:
+    cold: the containers are restarted before every round, so each round includes JVM start-up and cache fill
+    warm: the containers are started once with the Spark caches of datasets and search results disabled, so every
+    query reads the Delta tables again, but JVM and Spark session stay warm
+    steady: the containers are started once and every query is run once before the first round, nothing is reset
+    between rounds
+
+    @param reset_command: If provided, run in the Pathling container before every warm round, e.g.
+    'sync; echo 3 > /proc/sys/vm/drop_caches' to drop the page cache. Note that this drops the page cache of the
+    whole host and needs a writable /proc/sys.
+    """
+    assert mode in benchmark_modes, f"Unknown benchmark mode '{mode}'"
+    print(f"Running tests: mode: {mode}, rounds: {rounds}, number of pre-run queries: {num_pre_run_queries}, "
+          f"seed: {seed}")
+    rng = random.Random(seed)
+    result_sets = generate_result_sets(query_sets)
+
+    spark_app_id = None
+    if mode != 'cold':
+        restart_containers(project_name, warm_mode_environment if mode == 'warm' else None)
+        spark_app_id = get_spark_application_id(spark_ui_url) if spark_ui_url else None
+    if mode == 'steady':
+        print("Warming up with all queries")
+        _, warm_up_query_set = generate_test_run_order(query_sets, 0, rng)
+        run_pre_run_queries(warm_up_query_set, url, timeout)
+
+    for i in range(1, rounds + 1):
+        print(f"Round {i}")
+        pre_run_query_set, query_set = generate_test_run_order(query_sets, num_pre_run_queries, rng)
+
+        if mode == 'cold':
+            restart_containers(project_name)
+            spark_app_id = get_spark_application_id(spark_ui_url) if spark_ui_url else None
+        elif mode == 'warm' and reset_command:
+            reset_caches(project_name, reset_command)
 
+        run_pre_run_queries(pre_run_query_set, url, timeout)
+        run_measured_queries(query_set, result_sets, url, timeout, spark_ui_url, spark_app_id)
 
     # Generate report
     print("Processing results")
@@ -166,7 +289,8 @@ def run_test(query_sets, url, project_name, rounds=None, num_pre_run_queries=Non
             result_entry = {
                 'avg': str(calculate_avg([result['time'] for result in query_results])),
                 'times': [str(result['time']) for result in query_results],
-                'results': [str(result['result']) for result in query_results]
+                'results': [str(result['result']) for result in query_results],
+                'spark': [result['spark'] for result in query_results]
             }
             test_results[query_name] = result_entry
 
@@ -209,6 +333,20 @@ def configure_argparse():
                                                              datetime.datetime.today().strftime('%Y-%m-%d#%H:%M:%S') +
                                                              '.json'), help='Output file for report')
     parser.add_argument('-t', '--timeout', type=int, default=1800, help='Response time limit for requests')
+    parser.add_argument('-s', '--spark-ui-url', default='http://localhost:8040',
+                        help='Spark UI URL to collect job/stage metrics and query plans from, empty to disable')
+    parser.add_argument('-m', '--modes', nargs='+', choices=benchmark_modes, default=['cold'],
+                        help='Benchmark modes to run, each reported separately. cold: restart the containers '
+                             'before every round (new JVM, empty Spark caches, OS page cache kept). warm: start '
+                             'the containers once with Pathling\'s dataset and search result caching disabled, so '
+                             'every query reads the Delta tables again; JVM, Spark session and OS page cache stay '
+                             'warm, unless --reset-command drops the latter. steady: start the containers once '
+                             'with caching enabled and warm up with all queries once, nothing is reset')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the query order')
+    parser.add_argument('--reset-command',
+                        help='Command run privileged in the Pathling container before every warm round, e.g. '
+                             '"sync; echo 3 > /proc/sys/vm/drop_caches" to also drop the page cache (of the whole '
+                             'host). The benchmark fails if the command fails.')
     return parser
 
 
@@ -222,7 +360,11 @@ if __name__ == "__main__":
     request_timeout = args.timeout
 
     pathling_query_sets = load_queries(query_path, query_file_pattern)
-    pathling_test_result = run_test(pathling_query_sets, base_url, pathling_project_name, num_rounds,
-                                    num_pre_run_queries, request_timeout)
+    pathling_test_result = {}
+    for benchmark_mode in args.modes:
+        pathling_test_result[benchmark_mode] = run_test(pathling_query_sets, base_url, pathling_project_name,
+                                                        benchmark_mode, num_rounds, num_pre_run_queries,
+                                                        request_timeout, args.spark_ui_url, args.seed,
+                                                        args.reset_command)
 
     json.dump(pathling_test_result, fp=open(args.file, mode='w+'), indent=2)
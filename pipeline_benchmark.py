@@ -0,0 +1,273 @@
+# Offline benchmark of the /run_ccdl pipeline (staging, NDJSON conversion, import, extraction and merge) against local
+# stand-ins for the FHIR server, Flare and Pathling
+import os
+import json
+import time
+import argparse
+import datetime
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import tracemalloc
+
+from stand_in_servers import SyntheticDataset, FhirStandInServer, FlareStandInServer, PathlingStandInServer
+
+result_path = 'result'
+
+benchmark_view_definitions = [
+    {
+        "resource": "Patient",
+        "date": "2024-02-27T14:20:18.732269",
+        "fhirVersion": "4.0.1",
+        "resourceType": "http://hl7.org/fhir/uv/sql-on-fhir/StructureDefinition/ViewDefinition",
+        "name": "PatientView",
+        "status": "active",
+        "select": [{"column": [
+            {"name": "Patient id", "path": "Patient.id"},
+            {"name": "Gender", "path": "Patient.gender"},
+            {"name": "Birth date", "path": "Patient.birthDate"}
+        ]}]
+    },
+    {
+        "resource": "Condition",
+        "date": "2024-02-27T14:20:18.732269",
+        "fhirVersion": "4.0.1",
+        "resourceType": "http://hl7.org/fhir/uv/sql-on-fhir/StructureDefinition/ViewDefinition",
+        "name": "ConditionView",
+        "status": "active",
+        "select": [{"column": [
+            {"name": "Patient id", "path": "Condition.subject.resolve().ofType(Patient).id"},
+            {"name": "Condition code", "path": "Condition.code.coding.code"}
+        ]}]
+    }
+]
+
+
+class StageTimer:
+    """
+    Records wall-clock time and, if enabled, the peak traced Python memory of each pipeline stage
+    """
+
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    def run(self, stage: str, function, *args, **kwargs):
+        print(f"Running stage '{stage}'")
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[stage] = {'seconds': elapsed}
+            if self.trace_memory:
+                self.stages[stage]['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            print(f"Stage '{stage}' took {elapsed:.3f}s")
+
+
+def serve_stand_ins(connection, dataset: SyntheticDataset, latency: float, export_duration: float, staging_dir: str):
+    servers = [FhirStandInServer(dataset, latency, export_duration).start(),
+               FlareStandInServer(dataset, latency).start(),
+               PathlingStandInServer(dataset, latency, staging_dir).start()]
+    connection.send([server.base_url for server in servers])
+    # Serve until the benchmark asks to stop, then report the number of requests per server
+    connection.recv()
+    for server in servers:
+        server.stop()
+    connection.send([server.request_count for server in servers])
+
+
+class StandInProcess:
+    """
+    Runs the FHIR, Flare and Pathling stand-ins in a process of their own, so the memory they use to build whole
+    response bodies is not counted in the peak memory of the pipeline (tracemalloc and ru_maxrss of this process)
+
+    @param staging_dir: NDJSON directory of the pipeline, from which the Pathling stand-in reads the imported patients
+    """
+
+    def __init__(self, dataset: SyntheticDataset, latency: float, export_duration: float, staging_dir: str):
+        context = multiprocessing.get_context('spawn')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve_stand_ins, name='stand-ins', daemon=True,
+                                       args=(child_connection, dataset, latency, export_duration, staging_dir))
+        self.fhir_base_url = self.flare_base_url = self.pathling_base_url = None
+
+    def start(self):
+        self.process.start()
+        self.fhir_base_url, self.flare_base_url, self.pathling_base_url = self.connection.recv()
+        return self
+
+    def stop(self) -> dict:
+        """
+        @return: Number of requests per stand-in server
+        """
+        self.connection.send('stop')
+        fhir, flare, pathling = self.connection.recv()
+        self.process.join()
+        return {'fhir': fhir, 'flare': flare, 'pathling': pathling}
+
+
+def throughput(amount, seconds):
+    return amount / seconds if seconds > 0 else None
+
+
+def extract_and_consume(pipeline, view_definitions, patient_ids, output_format, stream_views):
+    # Consume the response body so that lazily generated output is part of the measured time
+    response = pipeline.run_extraction(view_definitions, patient_ids, output_format=output_format,
+                                       stream_views=stream_views)
+    return sum(len(chunk) for chunk in response.response)
+
+
+def plan_benchmark_projection(pipeline):
+    return pipeline.plan_projection([pipeline.ViewDefinition.from_json(json.dumps(definition))
+                                     for definition in benchmark_view_definitions])
+
+
+def run_benchmark_round(pipeline, dataset: SyntheticDataset, trace_memory: bool, output_format: str,
+                        projection: bool, preview_sample_size: int = None):
+    timer = StageTimer(trace_memory)
+
+    patient_ids = timer.run('cohort_query', pipeline.run_cohort_query, {})
+    if preview_sample_size:
+        patient_ids = pipeline.sample_cohort(patient_ids, preview_sample_size, pipeline.PREVIEW_SEED)
+    projection_plan = plan_benchmark_projection(pipeline) if projection else None
+    file_name_by_type, staging_statistics = timer.run('staging', pipeline.stage_cohort_data, patient_ids,
+                                                      projection_plan)
+
+    # Conversion on its own, i.e. without the time spent fetching from the FHIR server
+    bundle = {"resourceType": "Bundle", "type": "collection",
+              "entry": [{"resource": fhir_resource} for patient_id in patient_ids
+                        for fhir_resource in dataset.patient_resources(patient_id)]}
+    # Written to a directory of its own, so the files staged for the import are not overwritten
+    staging_dir = pipeline.NDJSON_DIR
+    with tempfile.TemporaryDirectory() as conversion_dir:
+        pipeline.NDJSON_DIR = conversion_dir
+        try:
+            timer.run('conversion', pipeline.write_fhir_bundle_to_ndjson, bundle, projection_plan)
+        finally:
+            pipeline.NDJSON_DIR = staging_dir
+    del bundle
+
+    timer.run('import', pipeline.import_staged_data, file_name_by_type)
+    output_bytes = timer.run('extraction', extract_and_consume, pipeline, benchmark_view_definitions,
+                             patient_ids, output_format, bool(preview_sample_size))
+
+    staged_resources = sum(statistics['count'] for statistics in staging_statistics.values())
+    staged_bytes = sum(statistics['bytes'] for statistics in staging_statistics.values())
+    stages = timer.stages
+    stages['staging']['resources_per_second'] = throughput(staged_resources, stages['staging']['seconds'])
+    stages['staging']['bytes_per_second'] = throughput(staged_bytes, stages['staging']['seconds'])
+    stages['conversion']['resources_per_second'] = throughput(staged_resources, stages['conversion']['seconds'])
+    stages['extraction']['output_bytes_per_second'] = throughput(output_bytes, stages['extraction']['seconds'])
+
+    return {
+        'patients': len(patient_ids),
+        'staged_resources': staged_resources,
+        'staged_bytes': staged_bytes,
+        'output_bytes': output_bytes,
+        'total_seconds': sum(stage['seconds'] for stage in stages.values()),
+        'stages': stages
+    }
+
+
+def run_benchmark(dataset: SyntheticDataset, rounds: int, latency: float, trace_memory: bool,
+                  partition_size: int = None, output_format: str = 'wide', staging_backend: str = 'everything',
+                  export_duration: float = 0.0, projection: bool = True, preview_sample_size: int = None):
+    ndjson_dir = tempfile.mkdtemp()
+    stand_ins = StandInProcess(dataset, latency, export_duration, ndjson_dir).start()
+
+    # main reads its endpoints from the environment on import
+    os.environ['FHIR_SERVER_BASE_URL'] = f"{stand_ins.fhir_base_url}/fhir"
+    os.environ['FLARE_BASE_URL'] = stand_ins.flare_base_url
+    os.environ['PATHLING_BASE_URL'] = f"{stand_ins.pathling_base_url}/fhir"
+    import main as pipeline
+    if partition_size:
+        pipeline.EXTRACT_PARTITION_SIZE = partition_size
+    pipeline.STAGING_BACKEND = staging_backend
+    pipeline.EXPORT_POLL_INTERVAL = 0.1
+
+    report = {
+        'configuration': {
+            'patients': dataset.num_patients,
+            'observations_per_patient': dataset.observations_per_patient,
+            'conditions_per_patient': dataset.conditions_per_patient,
+            'shared_resources_per_patient': dataset.shared_resources_per_patient,
+            'narrative_bytes': dataset.narrative_bytes,
+            'latency': latency,
+            'rounds': rounds,
+            'trace_memory': trace_memory,
+            'extract_partition_size': pipeline.EXTRACT_PARTITION_SIZE,
+            'output_format': output_format,
+            'staging_backend': staging_backend,
+            'export_duration': export_duration,
+            'projection': projection,
+            'preview_sample_size': preview_sample_size
+        },
+        'rounds': []
+    }
+
+    try:
+        pipeline.NDJSON_DIR = ndjson_dir
+        for i in range(1, rounds + 1):
+            print(f"Round {i}")
+            report['rounds'].append(run_benchmark_round(pipeline, dataset, trace_memory, output_format,
+                                                        projection, preview_sample_size))
+    finally:
+        report['requests'] = stand_ins.stop()
+        shutil.rmtree(ndjson_dir, ignore_errors=True)
+
+    # ru_maxrss is reported in KiB on Linux and does not include the stand-in process
+    report['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    report['avg_total_seconds'] = sum(round_report['total_seconds'] for round_report in report['rounds']) / rounds
+    return report
+
+
+def configure_argparse():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the /run_ccdl pipeline. Run from the '
+                                                 'repository root.')
+    parser.add_argument('-n', '--patients', type=int, default=100, help='Number of patients in the cohort')
+    parser.add_argument('--observations', type=int, default=20, help='Observations per patient')
+    parser.add_argument('--conditions', type=int, default=5, help='Conditions per patient')
+    parser.add_argument('--shared', type=int, default=4,
+                        help='Shared resources (Practitioner, Organization, ...) per patient')
+    parser.add_argument('--narrative-bytes', type=int, default=200, help='Size of the narrative text of each resource')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Latency in seconds added to every stand-in server response')
+    parser.add_argument('-r', '--rounds', type=int, default=3, help='Number of benchmark rounds')
+    parser.add_argument('-m', '--trace-memory', action='store_true',
+                        help='Record the peak Python memory per stage with tracemalloc (slows down all stages)')
+    parser.add_argument('-p', '--partition-size', type=int,
+                        help='Patients per $extract partition, defaults to EXTRACT_PARTITION_SIZE of main')
+    parser.add_argument('-o', '--output-format', choices=['wide', 'long', 'per_view'], default='wide',
+                        help='Output format of the extraction')
+    parser.add_argument('-b', '--staging-backend', choices=['everything', 'bulk_export'], default='everything',
+                        help='Staging backend of the pipeline')
+    parser.add_argument('--export-duration', type=float, default=0.0,
+                        help='Seconds the stand-in FHIR server takes to complete a bulk export')
+    parser.add_argument('--no-projection', dest='projection', action='store_false',
+                        help='Stage all resource types and elements instead of those the view definitions use')
+    parser.add_argument('--preview', type=int, dest='preview_sample_size',
+                        help='Only stage and extract a random sample of this many patients, as in preview mode')
+    parser.add_argument('-s', '--seed', type=int, default=42, help='Seed of the synthetic data')
+    parser.add_argument('-f', '--file', default=os.path.join(result_path, 'result_pipeline_' +
+                                                             datetime.datetime.today().strftime('%Y-%m-%d#%H:%M:%S') +
+                                                             '.json'), help='Output file for report')
+    return parser
+
+
+if __name__ == "__main__":
+    args = configure_argparse().parse_args()
+
+    synthetic_dataset = SyntheticDataset(args.patients, args.observations, args.conditions, args.shared,
+                                         narrative_bytes=args.narrative_bytes, seed=args.seed)
+    pipeline_report = run_benchmark(synthetic_dataset, args.rounds, args.latency, args.trace_memory,
+                                    args.partition_size, args.output_format, args.staging_backend,
+                                    args.export_duration, args.projection, args.preview_sample_size)
+
+    os.makedirs(os.path.dirname(args.file) or '.', exist_ok=True)
+    json.dump(pipeline_report, fp=open(args.file, mode='w+'), indent=2)
+    print(f"Report written to {args.file}")
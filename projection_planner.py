@@ -0,0 +1,201 @@
+# Planning of the resource types and top-level elements the view definitions of an extraction need
+import re
+from typing import Dict, List, Optional, Set
+
+from PathlingViewDefinitionRunner import ViewDefinition
+
+# Elements kept in every staged resource
+MANDATORY_ELEMENTS = {"resourceType", "id", "meta"}
+# Keywords of FHIRPath that are lexically identifiers, but operators
+OPERATOR_KEYWORDS = {"and", "or", "xor", "implies", "in", "contains", "div", "mod", "true", "false"}
+TYPE_OPERATORS = {"is", "as"}
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<string>'(?:[^'\\]|\\.)*')
+  | (?P<identifier>`[^`]*`|[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<variable>[$%][A-Za-z0-9_]*)
+  | (?P<literal>@[0-9T:\-+.Z]*|[0-9]+(?:\.[0-9]+)?)
+  | (?P<punctuation>[.(),])
+  | (?P<operator><=|>=|!=|!~|[=~<>|+\-*/&\[\]])
+  | (?P<space>\s+)
+""", re.VERBOSE)
+
+
+class ProjectionPlan:
+    """
+    Resource types and their top-level elements needed to evaluate a set of view definitions. A resource type mapped
+    to None is needed with all its elements, an unrestricted plan needs every resource type in full, e.g. because a
+    reference is resolved without the target type being known.
+    """
+
+    def __init__(self):
+        self.elements_by_type: Dict[str, Optional[Set[str]]] = {}
+        self.unrestricted = False
+
+    def require(self, resource_type: str, element: str = None):
+        if element is None:
+            self.elements_by_type[resource_type] = None
+            return
+        elements = self.elements_by_type.setdefault(resource_type, set(MANDATORY_ELEMENTS))
+        if elements is not None:
+            elements.add(element)
+
+    def resource_types(self, supported_resource_types: List[str]) -> List[str]:
+        if self.unrestricted:
+            return list(supported_resource_types)
+        return [resource_type for resource_type in supported_resource_types if resource_type in self.elements_by_type]
+
+    def elements_parameter(self) -> str:
+        """
+        @return: Value of the Bulk Data _elements parameter, empty if nothing can be left out
+        """
+        if self.unrestricted:
+            return ""
+        return ",".join(f"{resource_type}.{element}"
+                        for resource_type, elements in sorted(self.elements_by_type.items()) if elements
+                        for element in sorted(elements - {"resourceType"}))
+
+    def project(self, resource: dict) -> dict:
+        """
+        Strips all top-level elements the view definitions do not use from the resource. Choice elements (e.g. value
+        for valueQuantity) and the extensions of primitive elements (_birthDate) are kept with their element.
+        """
+        if self.unrestricted:
+            return resource
+        elements = self.elements_by_type.get(resource.get("resourceType"))
+        if elements is None:
+            return resource
+        return {key: value for key, value in resource.items() if self._is_needed(key.lstrip("_"), elements)}
+
+    @staticmethod
+    def _is_needed(key: str, elements: Set[str]) -> bool:
+        if key in elements:
+            return True
+        return any(key.startswith(element) and key[len(element):len(element) + 1].isupper() for element in elements)
+
+    def __repr__(self):
+        if self.unrestricted:
+            return "ProjectionPlan(unrestricted)"
+        return f"ProjectionPlan({self.elements_by_type})"
+
+
+def tokenize(expression: str) -> List[tuple]:
+    tokens = []
+    position = 0
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if not match:
+            raise ValueError(f"Unexpected character '{expression[position]}' in FHIRPath '{expression}'")
+        position = match.end()
+        if match.lastgroup != "space":
+            value = match.group()
+            if match.lastgroup == "identifier":
+                value = value.strip("`")
+            tokens.append((match.lastgroup, value))
+    return tokens
+
+
+def _closing_parenthesis(tokens: List[tuple], opening: int) -> int:
+    depth = 0
+    for index in range(opening, len(tokens)):
+        if tokens[index] == ("punctuation", "("):
+            depth += 1
+        elif tokens[index] == ("punctuation", ")"):
+            depth -= 1
+            if depth == 0:
+                return index
+    raise ValueError("Unbalanced parentheses in FHIRPath")
+
+
+def _collect(tokens: List[tuple], resource_type: str, plan: ProjectionPlan):
+    """
+    Walks the navigation chains of the expression on its top level. The first element navigated to from the resource
+    is recorded, everything below it is covered by keeping that element. Arguments of functions invoked on the
+    resource itself are relative to the resource and walked as expressions of their own.
+    """
+    context_type = resource_type
+    # start: a new chain begins, root: the next identifier is a top-level element, nested: below a top-level element
+    state = "start"
+    index = 0
+    while index < len(tokens):
+        kind, value = tokens[index]
+        is_call = index + 1 < len(tokens) and tokens[index + 1] == ("punctuation", "(")
+
+        if kind == "identifier" and is_call:
+            closing = _closing_parenthesis(tokens, index + 1)
+            arguments = tokens[index + 2:closing]
+            if value == "resolve":
+                following = tokens[closing + 1:closing + 6]
+                if (len(following) >= 5 and following[0] == ("punctuation", ".")
+                        and following[1] == ("identifier", "ofType") and following[3][0] == "identifier"):
+                    context_type = following[3][1]
+                    plan.require(context_type, "id")
+                    state = "root"
+                    closing += 5
+                else:
+                    # The type of the referenced resource is unknown
+                    plan.unrestricted = True
+                    state = "nested"
+            elif value == "reverseResolve":
+                if len(arguments) < 3 or arguments[0][0] != "identifier" or arguments[2][0] != "identifier":
+                    raise ValueError("Unsupported reverseResolve argument")
+                context_type = arguments[0][1]
+                plan.require(context_type, arguments[2][1])
+                state = "root"
+            elif value == "extension" and state != "nested":
+                plan.require(context_type, "extension")
+                state = "nested"
+            elif state != "nested":
+                # e.g. Observation.where(...), the arguments refer to the resource
+                _collect(arguments, context_type, plan)
+            index = closing + 1
+        elif kind == "identifier" and value in TYPE_OPERATORS:
+            # The type name following is not an element
+            index += 2
+            context_type, state = resource_type, "start"
+        elif kind == "identifier" and value not in OPERATOR_KEYWORDS:
+            if state == "start" and value == context_type:
+                state = "root"
+            elif state != "nested":
+                plan.require(context_type, value)
+                state = "nested"
+            index += 1
+        elif kind == "variable" and state == "start":
+            # $this and %resource refer to the resource
+            state = "root"
+            index += 1
+        elif (kind, value) == ("punctuation", "."):
+            index += 1
+        elif (kind, value) == ("punctuation", "("):
+            closing = _closing_parenthesis(tokens, index)
+            _collect(tokens[index + 1:closing], context_type, plan)
+            index = closing + 1
+            state = "nested"
+        elif kind in ("string", "literal"):
+            # Navigation from a literal does not refer to elements of the resource
+            state = "nested"
+            index += 1
+        else:
+            # Operators, literals and argument separators end the chain
+            context_type, state = resource_type, "start"
+            index += 1
+
+
+def plan_projection(view_definitions: List[ViewDefinition]) -> ProjectionPlan:
+    """
+    Computes the resource types and top-level elements the column and where paths of the view definitions navigate
+    to. Paths that can not be analysed make the resource type of their view required in full.
+    """
+    plan = ProjectionPlan()
+    for view_definition in view_definitions:
+        resource_type = view_definition.resource
+        plan.require(resource_type, "id")
+        paths = [column.path for select in view_definition.select for column in select.column]
+        paths += [where.path for where in view_definition.where]
+        for path in paths:
+            try:
+                _collect(tokenize(path), resource_type, plan)
+            except ValueError as exc:
+                print(f"Can not plan projection of '{path}', staging {resource_type} in full: {exc}")
+                plan.require(resource_type)
+    return plan
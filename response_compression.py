@@ -0,0 +1,60 @@
+# Incremental compression of streamed responses
+import zlib
+from typing import Iterable, Iterator, Optional, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def supported_encodings():
+    return ["zstd", "gzip"] if zstandard else ["gzip"]
+
+
+def negotiate_content_encoding(accept_encodings) -> Optional[str]:
+    """
+    @param accept_encodings: Accept-Encoding header of the request as parsed by werkzeug
+    @return: Preferred supported encoding of the client, None if the response should not be compressed
+    """
+    return accept_encodings.best_match(supported_encodings())
+
+
+def _compressor(content_encoding: str):
+    if content_encoding == "gzip":
+        # wbits 31 writes the gzip header and trailer
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    if content_encoding == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Unsupported content encoding '{content_encoding}'")
+
+
+def _sync_flush(compressor, content_encoding: str) -> bytes:
+    if content_encoding == "gzip":
+        return compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+
+def compress_stream(chunks: Iterable[Union[str, bytes]], content_encoding: Optional[str],
+                    flush_chunks: bool = False) -> Iterator[bytes]:
+    """
+    Compresses the chunks one by one as they are produced, so the payload is never held in memory as a whole
+
+    @param content_encoding: gzip or zstd, None passes the chunks through uncompressed
+    @param flush_chunks: Flush the compressor after every chunk, so the client can decompress each chunk as soon as
+    it arrives instead of once the compressor's buffer is full
+    """
+    compressor = _compressor(content_encoding) if content_encoding else None
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk) if compressor else chunk
+        if compressor and flush_chunks:
+            data += _sync_flush(compressor, content_encoding)
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
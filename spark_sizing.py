@@ -0,0 +1,134 @@
+# Sizing of the Spark/JVM settings of the Pathling instance based on the staged data volume
+import math
+import os
+from typing import Dict, Optional
+
+GIB = 1024 ** 3
+MIB = 1024 ** 2
+
+# Amount of staged NDJSON data that one shuffle partition should roughly handle
+TARGET_BYTES_PER_PARTITION = 64 * MIB
+MAX_SHUFFLE_PARTITIONS = 2000
+
+# Heap that Pathling needs regardless of the data volume (Spring, Spark, Delta, terminology client)
+BASE_HEAP_BYTES = 2 * GIB
+# Encoded and cached datasets need considerably more memory than the NDJSON they were imported from
+HEAP_BYTES_PER_STAGED_BYTE = 6
+# Share of the host memory the Pathling JVM may claim at most
+MAX_HOST_MEMORY_FRACTION = 0.75
+
+JVM_OPTIONS = "-XX:MaxMetaspaceSize=500m -XX:ReservedCodeCacheSize=240m -Xss1m"
+
+# Limits of the container this service runs in (a docker:dind container, which also hosts the Pathling container)
+CGROUP_DIR = "/sys/fs/cgroup"
+
+
+class SparkSizingProfile:
+    """
+    Spark/JVM settings for a single Pathling run, passed to the Pathling container through the environment of
+    docker-compose.yml
+
+    @param shuffle_partitions: Value for spark.sql.shuffle.partitions
+    @param cores: Number of cores of the local Spark master, i.e. spark.master local[cores], as Pathling runs Spark
+    locally and spark.executor.cores has no effect then
+    @param heap_size_gb: Maximum JVM heap size in GiB (-Xmx), which bounds the memory of the local Spark session
+    """
+
+    def __init__(self, shuffle_partitions: int, cores: int, heap_size_gb: int):
+        self.shuffle_partitions = shuffle_partitions
+        self.cores = cores
+        self.heap_size_gb = heap_size_gb
+
+    def to_env(self) -> Dict[str, str]:
+        return {
+            "SPARK_SHUFFLE_PARTITIONS": str(self.shuffle_partitions),
+            "SPARK_MASTER": f"local[{self.cores}]",
+            "JAVA_TOOL_OPTIONS": f"-Xmx{self.heap_size_gb}g {JVM_OPTIONS}"
+        }
+
+    def __repr__(self):
+        return (f"SparkSizingProfile(shuffle_partitions={self.shuffle_partitions}, "
+                f"cores={self.cores}, heap_size_gb={self.heap_size_gb})")
+
+
+def _read_cgroup_file(*path: str) -> Optional[str]:
+    try:
+        with open(os.path.join(CGROUP_DIR, *path)) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def get_cgroup_memory_limit() -> Optional[int]:
+    """
+    @return: Memory limit of the cgroup of this process in bytes (cgroup v2, else v1), None if it is unlimited
+    """
+    limit = _read_cgroup_file("memory.max") or _read_cgroup_file("memory", "memory.limit_in_bytes")
+    if not limit or not limit.isdigit():
+        return None
+    # cgroup v1 reports an unlimited memory as a huge number close to the maximum 64 bit value
+    return int(limit) if int(limit) < 2 ** 60 else None
+
+
+def get_cgroup_cpu_limit() -> Optional[int]:
+    """
+    @return: Number of cores the CPU quota of the cgroup of this process allows (cgroup v2, else v1), None if it is
+    unlimited
+    """
+    cpu_max = _read_cgroup_file("cpu.max")
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+    else:
+        quota = _read_cgroup_file("cpu", "cpu.cfs_quota_us")
+        period = _read_cgroup_file("cpu", "cpu.cfs_period_us")
+    if not quota or not period or not quota.isdigit() or not period.isdigit() or int(period) == 0:
+        return None
+    return max(1, math.ceil(int(quota) / int(period)))
+
+
+def get_host_resources():
+    """
+    @return: Number of CPU cores available to this process and memory available to it in bytes, i.e. the physical
+    memory of the host and its cores, reduced to the limits of the container's cgroup
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    memory_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    cpu_limit = get_cgroup_cpu_limit()
+    if cpu_limit:
+        cores = min(cores, cpu_limit)
+    memory_limit = get_cgroup_memory_limit()
+    if memory_limit:
+        memory_bytes = min(memory_bytes, memory_limit)
+    return cores, memory_bytes
+
+
+def compute_sizing_profile(staging_statistics: Dict[str, Dict[str, int]], host_cores: int = None,
+                           host_memory_bytes: int = None) -> SparkSizingProfile:
+    """
+    Derives the Spark/JVM settings from the volume of the staged data and the resources of the host
+
+    @param staging_statistics: Number of resources ("count") and NDJSON bytes ("bytes") per resource type as collected
+    by write_ndjson_by_resource_type
+    @param host_cores: Number of CPU cores available, detected if not provided
+    @param host_memory_bytes: Memory available in bytes, detected if not provided
+    """
+    if host_cores is None or host_memory_bytes is None:
+        detected_cores, detected_memory_bytes = get_host_resources()
+        host_cores = host_cores or detected_cores
+        host_memory_bytes = host_memory_bytes or detected_memory_bytes
+
+    staged_bytes = sum(statistics["bytes"] for statistics in staging_statistics.values())
+
+    # At least one task per core, beyond that scale with the data volume in whole waves of tasks
+    waves = max(1, math.ceil(staged_bytes / (TARGET_BYTES_PER_PARTITION * host_cores)))
+    shuffle_partitions = min(MAX_SHUFFLE_PARTITIONS, waves * host_cores)
+
+    max_heap_gb = max(1, int(host_memory_bytes * MAX_HOST_MEMORY_FRACTION // GIB))
+    required_heap_gb = math.ceil((BASE_HEAP_BYTES + staged_bytes * HEAP_BYTES_PER_STAGED_BYTE) / GIB)
+    heap_size_gb = min(max_heap_gb, required_heap_gb)
+
+    return SparkSizingProfile(shuffle_partitions, host_cores, heap_size_gb)
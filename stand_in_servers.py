@@ -0,0 +1,381 @@
+# Local stand-ins for the FHIR server, Flare and Pathling generating synthetic data for offline benchmarks
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import urlparse, parse_qs
+
+OBSERVATION_CODES = [("8302-2", "Body height"), ("29463-7", "Body weight"), ("8867-4", "Heart rate"),
+                     ("2339-0", "Glucose"), ("718-7", "Hemoglobin")]
+CONDITION_CODES = [("E11.9", "Type 2 diabetes mellitus"), ("I10", "Essential hypertension"),
+                   ("J45.9", "Asthma"), ("C50.9", "Malignant neoplasm of breast")]
+SHARED_RESOURCE_TYPES = ["Practitioner", "Organization", "Medication", "Location"]
+
+
+class SyntheticDataset:
+    """
+    Deterministic synthetic FHIR data of a cohort. The resources of a patient are generated on demand from the seed and
+    the patient index, so arbitrarily large cohorts do not need to be held in memory.
+
+    @param num_patients: Number of patients in the cohort
+    @param observations_per_patient: Number of Observations per patient
+    @param conditions_per_patient: Number of Conditions per patient
+    @param shared_resources_per_patient: Number of shared resources (Practitioner, Organization, ...) referenced by
+    each patient, drawn from a pool of shared_resource_pool_size resources per type
+    @param narrative_bytes: Size of the narrative text of each resource
+    """
+
+    def __init__(self, num_patients: int, observations_per_patient: int = 20, conditions_per_patient: int = 5,
+                 shared_resources_per_patient: int = 4, shared_resource_pool_size: int = 50,
+                 narrative_bytes: int = 200, seed: int = 42):
+        self.num_patients = num_patients
+        self.observations_per_patient = observations_per_patient
+        self.conditions_per_patient = conditions_per_patient
+        self.shared_resources_per_patient = shared_resources_per_patient
+        self.shared_resource_pool_size = shared_resource_pool_size
+        self.narrative_bytes = narrative_bytes
+        self.seed = seed
+
+    @property
+    def patient_ids(self) -> List[str]:
+        return [self.patient_id(index) for index in range(self.num_patients)]
+
+    @staticmethod
+    def patient_id(index: int) -> str:
+        return f"pat-{index:07d}"
+
+    @staticmethod
+    def patient_index(patient_id: str) -> int:
+        return int(patient_id.split("-")[-1])
+
+    def _narrative(self, label: str) -> dict:
+        filler = ("x" * self.narrative_bytes)[:max(0, self.narrative_bytes - len(label))]
+        return {"status": "generated", "div": f"<div xmlns=\"http://www.w3.org/1999/xhtml\">{label}{filler}</div>"}
+
+    def shared_resource(self, resource_type: str, index: int) -> dict:
+        resource_id = f"{resource_type.lower()}-{index:04d}"
+        return {
+            "resourceType": resource_type,
+            "id": resource_id,
+            "meta": {"versionId": "1"},
+            "text": self._narrative(resource_id)
+        }
+
+    def patient_resources(self, patient_id: str) -> List[dict]:
+        rng = random.Random(f"{self.seed}-{patient_id}")
+        subject = {"reference": f"Patient/{patient_id}"}
+        resources = [{
+            "resourceType": "Patient",
+            "id": patient_id,
+            "meta": {"versionId": "1"},
+            "text": self._narrative(patient_id),
+            "gender": rng.choice(["male", "female"]),
+            "birthDate": f"{rng.randint(1930, 2010)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        }]
+        for index in range(self.observations_per_patient):
+            code, display = rng.choice(OBSERVATION_CODES)
+            resources.append({
+                "resourceType": "Observation",
+                "id": f"obs-{patient_id}-{index}",
+                "meta": {"versionId": "1"},
+                "text": self._narrative(display),
+                "status": "final",
+                "code": {"coding": [{"system": "http://loinc.org", "code": code, "display": display}]},
+                "subject": subject,
+                "effectiveDateTime": f"20{rng.randint(10, 23)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "valueQuantity": {"value": round(rng.uniform(1, 200), 2), "unit": "1"}
+            })
+        for index in range(self.conditions_per_patient):
+            code, display = rng.choice(CONDITION_CODES)
+            resources.append({
+                "resourceType": "Condition",
+                "id": f"cond-{patient_id}-{index}",
+                "meta": {"versionId": "1"},
+                "text": self._narrative(display),
+                "code": {"coding": [{"system": "http://fhir.de/CodeSystem/bfarm/icd-10-gm", "code": code,
+                                     "display": display}]},
+                "subject": subject,
+                "recordedDate": f"20{rng.randint(10, 23)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+            })
+        for _ in range(self.shared_resources_per_patient):
+            resources.append(self.shared_resource(rng.choice(SHARED_RESOURCE_TYPES),
+                                                  rng.randrange(self.shared_resource_pool_size)))
+        return resources
+
+    def rows_per_patient(self, resource_type: str) -> int:
+        return {"Observation": self.observations_per_patient,
+                "Condition": self.conditions_per_patient}.get(resource_type, 1)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, with Nagle's algorithm every keep-alive response would wait for the
+    # delayed ACK of the client
+    disable_nagle_algorithm = True
+    # Set on the subclass created by StandInServer
+    stand_in = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str = "application/fhir+json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, payload, headers=None):
+        self.send_body(status, json.dumps(payload).encode("utf-8"), headers=headers)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        self.stand_in.handle(self, "GET")
+
+    def do_POST(self):
+        self.stand_in.handle(self, "POST")
+
+    def do_DELETE(self):
+        self.stand_in.handle(self, "DELETE")
+
+
+class StandInServer:
+    """
+    Base class of the stand-in servers. Each server runs in a daemon thread on a free local port and delays every
+    response by the configured latency in seconds.
+    """
+
+    def __init__(self, dataset: SyntheticDataset, latency: float = 0.0):
+        self.dataset = dataset
+        self.latency = latency
+        self.request_count = 0
+        self._lock = threading.Lock()
+        handler = type(f"{type(self).__name__}Handler", (StandInHandler,), {"stand_in": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, handler: StandInHandler, method: str):
+        with self._lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(handler.path)
+        self.route(handler, method, url.path, {key: values[0] for key, values in parse_qs(url.query).items()})
+
+    def route(self, handler: StandInHandler, method: str, path: str, query: dict):
+        raise NotImplementedError
+
+
+class FhirStandInServer(StandInServer):
+    """
+    Source FHIR server answering Patient/[id]/$everything with paged searchset Bundles and supporting the Bulk Data
+    Group/[id]/$export of Groups created on it. Export jobs complete export_duration seconds after their kick-off and
+    write one NDJSON file per resource type and patients_per_file patients.
+    """
+
+    everything_pattern = re.compile(r"^/fhir/Patient/([^/]+)/\$everything$")
+    group_pattern = re.compile(r"^/fhir/Group/([^/]+)$")
+    export_pattern = re.compile(r"^/fhir/Group/([^/]+)/\$export$")
+    export_resource_types = ["Patient", "Observation", "Condition"]
+
+    def __init__(self, dataset: SyntheticDataset, latency: float = 0.0, export_duration: float = 0.0,
+                 patients_per_file: int = 1000):
+        super().__init__(dataset, latency)
+        self.export_duration = export_duration
+        self.patients_per_file = patients_per_file
+        self.groups = {}
+        self.exports = {}
+
+    def route(self, handler, method, path, query):
+        everything_match = self.everything_pattern.match(path)
+        group_match = self.group_pattern.match(path)
+        export_match = self.export_pattern.match(path)
+        if method == "GET" and everything_match:
+            self.everything(handler, everything_match.group(1), query)
+        elif method == "POST" and path == "/fhir/Group":
+            group = json.loads(handler.read_body())
+            group["id"] = str(uuid.uuid4())
+            self.groups[group["id"]] = [member["entity"]["reference"].split("/")[-1] for member in group["member"]]
+            handler.send_json(201, group, headers={"Location": f"{self.base_url}/fhir/Group/{group['id']}"})
+        elif method == "DELETE" and group_match and group_match.group(1) in self.groups:
+            del self.groups[group_match.group(1)]
+            handler.send_body(204, b"")
+        elif method == "GET" and export_match and export_match.group(1) in self.groups:
+            self.kick_off_export(handler, export_match.group(1), query)
+        elif method == "GET" and path == "/fhir/$export-status" and query.get("job") in self.exports:
+            self.export_status(handler, query["job"])
+        elif method == "DELETE" and path == "/fhir/$export-status" and query.get("job") in self.exports:
+            del self.exports[query["job"]]
+            handler.send_body(202, b"")
+        elif method == "GET" and path == "/fhir/$export-file" and query.get("job") in self.exports:
+            self.export_file(handler, query["job"], query["type"], int(query["part"]))
+        else:
+            handler.send_json(404, {"resourceType": "OperationOutcome"})
+
+    def everything(self, handler, patient_id, query):
+        count = int(query.get("_count", 50))
+        offset = int(query.get("_offset", 0))
+        resources = self.dataset.patient_resources(patient_id)
+        page = resources[offset:offset + count]
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(resources),
+            "link": [],
+            "entry": [{"fullUrl": f"{self.base_url}/fhir/{resource['resourceType']}/{resource['id']}",
+                       "resource": resource} for resource in page]
+        }
+        if offset + count < len(resources):
+            bundle["link"].append({
+                "relation": "next",
+                "url": f"{self.base_url}/fhir/Patient/{patient_id}/$everything?_count={count}&_offset={offset + count}"
+            })
+        handler.send_json(200, bundle)
+
+    def kick_off_export(self, handler, group_id, query):
+        requested_types = query.get("_type", "").split(",") if query.get("_type") else self.export_resource_types
+        job_id = str(uuid.uuid4())
+        self.exports[job_id] = {
+            "patient_ids": list(self.groups[group_id]),
+            "types": [resource_type for resource_type in self.export_resource_types if resource_type in requested_types],
+            "completes_at": time.monotonic() + self.export_duration
+        }
+        handler.send_body(202, b"", headers={"Content-Location": f"{self.base_url}/fhir/$export-status?job={job_id}"})
+
+    def export_status(self, handler, job_id):
+        export = self.exports[job_id]
+        if time.monotonic() < export["completes_at"]:
+            handler.send_body(202, b"", headers={"X-Progress": "in-progress", "Retry-After": "1"})
+            return
+        num_parts = math.ceil(len(export["patient_ids"]) / self.patients_per_file)
+        handler.send_json(200, {
+            "transactionTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "request": f"{self.base_url}/fhir/Group/$export",
+            "requiresAccessToken": False,
+            "output": [{"type": resource_type,
+                        "url": f"{self.base_url}/fhir/$export-file?job={job_id}&type={resource_type}&part={part}"}
+                       for resource_type in export["types"] for part in range(num_parts)],
+            "error": []
+        })
+
+    def export_file(self, handler, job_id, resource_type, part):
+        patient_ids = self.exports[job_id]["patient_ids"][part * self.patients_per_file:
+                                                          (part + 1) * self.patients_per_file]
+        lines = [json.dumps(resource) for patient_id in patient_ids
+                 for resource in self.dataset.patient_resources(patient_id)
+                 if resource["resourceType"] == resource_type]
+        handler.send_body(200, "".join(line + "\n" for line in lines).encode("utf-8"),
+                          content_type="application/fhir+ndjson")
+
+
+class FlareStandInServer(StandInServer):
+    """
+    Flare returning the IDs of all patients of the synthetic dataset for any structured query
+    """
+
+    def route(self, handler, method, path, query):
+        if method != "POST" or path != "/query/execute-cohort":
+            handler.send_json(404, {})
+            return
+        handler.read_body()
+        handler.send_json(200, self.dataset.patient_ids)
+
+
+class PathlingStandInServer(StandInServer):
+    """
+    Pathling accepting $import requests and answering $extract with CSV results of the configured size. The first column
+    of every extract contains the patient ID, all other columns synthetic values.
+
+    @param staging_dir: Local directory backing the staging directory the $import URLs point to. If provided, extracts
+    only return rows of the patients in the last imported Patient files, otherwise of all patients of the dataset.
+    """
+
+    extract_pattern = re.compile(r"^/fhir/([^/]+)/\$extract$")
+    bound_pattern = re.compile(r"(>=|<) '([^']*)'")
+
+    def __init__(self, dataset: SyntheticDataset, latency: float = 0.0, staging_dir: str = None):
+        super().__init__(dataset, latency)
+        self.jobs = {}
+        self.staging_dir = staging_dir
+        self.patient_ids = [] if staging_dir else dataset.patient_ids
+
+    def import_data(self, parameters: dict):
+        # Like Pathling's default overwrite mode, an import of Patient files replaces the imported patients
+        if not self.staging_dir:
+            return
+        patient_files = []
+        for source in parameters.get("parameter", []):
+            parts = {part["name"]: part.get("valueCode") or part.get("valueUrl") for part in source.get("part", [])}
+            if parts.get("resourceType") == "Patient":
+                patient_files.append(os.path.join(self.staging_dir, os.path.basename(urlparse(parts["url"]).path)))
+        if not patient_files:
+            return
+        patient_ids = set()
+        for patient_file in patient_files:
+            with open(patient_file) as file:
+                patient_ids.update(json.loads(line)["id"] for line in file if line.strip())
+        self.patient_ids = sorted(patient_ids)
+
+    def route(self, handler, method, path, query):
+        match = self.extract_pattern.match(path)
+        if method == "POST" and path == "/fhir/$import":
+            self.import_data(json.loads(handler.read_body()))
+            handler.send_json(200, {"resourceType": "OperationOutcome", "issue": [
+                {"severity": "information", "code": "informational", "diagnostics": "Data import completed"}]})
+        elif method == "POST" and match:
+            parameters = json.loads(handler.read_body())
+            job_id = str(uuid.uuid4())
+            self.jobs[job_id] = (match.group(1), parameters)
+            handler.send_json(200, {"resourceType": "Parameters", "parameter": [
+                {"name": "url", "valueUrl": f"{self.base_url}/fhir/$result?id={job_id}"}]})
+        elif method == "GET" and path == "/fhir/$result" and query.get("id") in self.jobs:
+            resource_type, parameters = self.jobs.pop(query["id"])
+            handler.send_body(200, self.extract_csv(resource_type, parameters), content_type="text/csv")
+        else:
+            handler.send_json(404, {"resourceType": "OperationOutcome"})
+
+    @staticmethod
+    def matches_partition_filters(patient_id: str, filters: List[str]) -> bool:
+        # Only the patient ID range filters created by create_partition_filters are evaluated
+        for partition_filter in filters:
+            for operator, bound in PathlingStandInServer.bound_pattern.findall(partition_filter):
+                bound = bound.split("/")[-1]
+                if (operator == ">=" and patient_id < bound) or (operator == "<" and patient_id >= bound):
+                    return False
+        return True
+
+    def extract_csv(self, resource_type: str, parameters: dict) -> bytes:
+        num_columns = len([param for param in parameters.get("parameter", []) if param.get("name") == "column"])
+        filters = [param["valueString"] for param in parameters.get("parameter", []) if param.get("name") == "filter"]
+        rows_per_patient = self.dataset.rows_per_patient(resource_type)
+        lines = []
+        for patient_id in self.patient_ids:
+            if not self.matches_partition_filters(patient_id, filters):
+                continue
+            for row in range(rows_per_patient):
+                values = [patient_id] + [f"{resource_type}-{row}-{column}" for column in range(1, num_columns)]
+                lines.append(",".join(values))
+        return "".join(line + "\n" for line in lines).encode("utf-8")